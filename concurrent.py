@@ -0,0 +1,254 @@
+"""
+Future for asynchronous results on the IOLoop, and a thread pool to run
+blocking calls off the loop.
+"""
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import sys
+import functools
+import multiprocessing
+import threading
+
+try:
+    import Queue as queue  # py2
+except ImportError:
+    import queue  # py3
+
+from nida.ioevent import IOLoop
+from nida.log import app_log
+
+
+class Future(object):
+    """
+    A placeholder of an asynchronous result.
+
+    Unlike `concurrent.futures.Future`, it is not thread-safe and never blocks:
+    `result` raises if the future is not done. Done callbacks are called with
+    the future through `IOLoop.add_callback` of the current IOLoop when the
+    result is set, or on the next iteration if it is done already.
+
+    Example:
+        def fetch_both():
+            future = Future()
+            results = []
+
+            def on_fetch(data):
+                results.append(data)
+                if len(results) == 2:
+                    future.set_result(results)
+
+            backend_a.fetch(on_fetch)
+            backend_b.fetch(on_fetch)
+            return future
+
+        IOLoop.current().add_future(fetch_both(), on_both_done)
+    """
+    __slots__ = ['_done', '_result', '_exc_info', '_callbacks']
+
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        #created when the first callback is added.
+        self._callbacks = None
+
+    def cancel(self):
+        return False
+
+    def cancelled(self):
+        return False
+
+    def running(self):
+        return not self._done
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        """
+        Return the result or raise the exception of the future.
+        """
+        if not self._done:
+            raise RuntimeError("Future is not done")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        if not self._done:
+            raise RuntimeError("Future is not done")
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def exc_info(self):
+        return self._exc_info
+
+    def add_done_callback(self, fn):
+        """
+        Call fn with the future when it is done.
+        """
+        if self._done:
+            IOLoop.current().add_callback(fn, self)
+        elif self._callbacks is None:
+            self._callbacks = [fn]
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exception):
+        self.set_exc_info((exception.__class__, exception, None))
+
+    def set_exc_info(self, exc_info):
+        """
+        Set the exception with a ``sys.exc_info()`` triple, the traceback is
+        kept when result() raises.
+        """
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        if self._done:
+            raise RuntimeError("Future has been done")
+        self._done = True
+        callbacks = self._callbacks
+        if callbacks is not None:
+            self._callbacks = None
+            ioloop = IOLoop.current()
+            for fn in callbacks:
+                ioloop.add_callback(fn, self)
+
+
+def is_future(obj):
+    return isinstance(obj, Future)
+
+def future_from_call(func, *args, **kwargs):
+    """
+    Call func and wrap its result or exception in a future, a future returned
+    by func is returned as is.
+    """
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        future = Future()
+        future.set_exc_info(sys.exc_info())
+        return future
+    if is_future(result):
+        return result
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class ThreadPoolExecutor(object):
+    """
+    A thread pool for blocking calls, see `IOLoop.run_in_executor`.
+
+    A thread is started when work is submitted and no thread is idle, at
+    most ``max_workers`` threads. If
+    ``max_queue`` is greater than 0, at most ``max_queue`` calls wait in the
+    queue and submit raises ``Queue.Full`` when the queue is full, so the
+    loop never blocks on a busy pool.
+    """
+    def __init__(self, max_workers=None, max_queue=0):
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count() * 5
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than 0")
+        self.max_workers = max_workers
+        self._queue = queue.Queue(max_queue)
+        self._threads = []
+        #released by a worker each time it is done with a call and idle.
+        self._idle = threading.Semaphore(0)
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) to run in a worker thread. Unlike
+        `concurrent.futures`, nothing is returned, fn reports its own result.
+        """
+        if self._shutdown:
+            raise RuntimeError("Cannot submit after shutdown")
+        self._queue.put_nowait(functools.partial(fn, *args, **kwargs))
+        #an idle worker takes the call.
+        if self._idle.acquire(False):
+            return
+        if len(self._threads) < self.max_workers:
+            self._start_thread()
+
+    def qsize(self):
+        """
+        Return the number of calls waiting for a thread.
+        """
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _start_thread(self):
+        with self._lock:
+            if self._shutdown or len(self._threads) >= self.max_workers:
+                return
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            self._threads.append(thread)
+        thread.start()
+
+    def _work(self):
+        while True:
+            call = self._queue.get()
+            if call is None:
+                return
+            try:
+                call()
+            except Exception:
+                app_log.error("Exception in executor call %r", call,
+                              exc_info=True)
+            self._idle.release()
+
+def run_on_executor(*args, **kwargs):
+    """
+    Decorator to run a method in ``self.executor`` and return a Future of its
+    result, which is set on ``self.ioloop`` (the current IOLoop if there is no
+    such attribute). Other attribute names can be given by keywords:
+
+        class Handler(object):
+            def __init__(self):
+                self.ioloop = IOLoop.current()
+                self._pool = ThreadPoolExecutor(4, max_queue=100)
+
+            @run_on_executor(executor="_pool")
+            def query(self, sql):
+                return self.db.execute(sql)
+    """
+    def run_on_executor_decorator(fn):
+        executor = kwargs.get("executor", "executor")
+        ioloop = kwargs.get("ioloop", "ioloop")
+
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            loop = getattr(self, ioloop, None) or IOLoop.current()
+            return loop.run_in_executor(getattr(self, executor),
+                                        functools.partial(fn, self, *args,
+                                                          **kwargs))
+        return wrapper
+
+    if args and kwargs:
+        raise ValueError("Cannot combine positional and keyword args")
+    if len(args) == 1:
+        return run_on_executor_decorator(args[0])
+    elif len(args) != 0:
+        raise ValueError("Expected 1 argument, got %d" % len(args))
+    return run_on_executor_decorator
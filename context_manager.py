@@ -173,6 +173,7 @@ def wrap(func):
                 _stack.contexts = current_contexts
 
         null_wrapper._has_wrapped = True
+        null_wrapper.__wrapped__ = func
         return null_wrapper
     
     def wrapped(*args, **kwargs):
@@ -250,6 +251,7 @@ def wrap(func):
         return ret
     
     wrapped._has_wrapped = True
+    wrapped.__wrapped__ = func
     return wrapped
 
 def _handle_excp(top, excp):
@@ -0,0 +1,121 @@
+"""
+Benchmark of IOLoop poller backends.
+
+For every available poller, measure:
+    1. idle scaling: the round trip time of one active connection while N
+       idle connections are registered.
+    2. active throughput: round trips per second when all connections are
+       active at the same time.
+
+    python poller_benchmark.py --pollers=epoll,poll,select --idle=0,100,500
+"""
+from __future__ import absolute_import, division, print_function
+
+import env
+import socket
+import time
+
+from nida.ioevent import IOLoop
+from nida.options import define, options, parse_command
+
+define("pollers", type=str, default="", help="comma separated pollers to "
+       "benchmark, all available default")
+define("idle", type=str, default="0,100,500,900", help="comma separated idle "
+       "connection numbers")
+define("active", type=str, default="1,10,100,400", help="comma separated "
+       "active connection numbers")
+define("round_trips", type=int, default=20000, help="round trips per run")
+
+MESSAGE = b"x" * 64
+
+
+class PingPong(object):
+    """
+    Bounce a message on a socket pair until ``counter`` reaches the limit.
+    """
+    def __init__(self, ioloop, counter, limit):
+        self.ioloop = ioloop
+        self.counter = counter
+        self.limit = limit
+        self.client, self.server = socket.socketpair()
+        for sock in (self.client, self.server):
+            sock.setblocking(False)
+        ioloop.add_handler(self.server, self.on_server, ioloop.READ)
+        ioloop.add_handler(self.client, self.on_client, ioloop.READ)
+
+    def start(self):
+        self.client.send(MESSAGE)
+
+    def on_server(self, sock, events):
+        sock.send(sock.recv(4096))
+
+    def on_client(self, sock, events):
+        sock.recv(4096)
+        self.counter[0] += 1
+        if self.counter[0] >= self.limit:
+            self.ioloop.stop()
+        else:
+            sock.send(MESSAGE)
+
+
+def idle_pairs(ioloop, num):
+    pairs = []
+    for _ in range(num):
+        a, b = socket.socketpair()
+        ioloop.add_handler(a, lambda fd, events: None, ioloop.READ)
+        pairs.append((a, b))
+    return pairs
+
+
+def run(poller, idle, active, round_trips):
+    """
+    Return (seconds per round trip, round trips per second).
+    """
+    IOLoop.configure(poller)
+    ioloop = IOLoop()
+    ioloop.make_current()
+    idle_socks = idle_pairs(ioloop, idle)
+    counter = [0]
+    pingpongs = [PingPong(ioloop, counter, round_trips) for _ in range(active)]
+    ioloop.add_callback(lambda: [p.start() for p in pingpongs])
+    start = time.time()
+    ioloop.start()
+    elapsed = time.time() - start
+    #closes the active sockets registered in the loop.
+    ioloop.close()
+    for a, b in idle_socks:
+        b.close()
+    for pingpong in pingpongs:
+        pingpong.client.close()
+    return elapsed / counter[0], counter[0] / elapsed
+
+
+def main():
+    parse_command()
+    pollers = [p for p in options.pollers.split(",") if p] or IOLoop.pollers()
+    idles = [int(n) for n in options.idle.split(",")]
+    actives = [int(n) for n in options.active.split(",")]
+
+    print("idle scaling: one active connection, N idle ones")
+    print("%-8s %8s %16s" % ("poller", "idle", "us/round trip"))
+    for poller in pollers:
+        for idle in idles:
+            #select can not watch fds over FD_SETSIZE.
+            if poller == "select" and idle * 2 + 16 > 1024:
+                continue
+            per_trip, _ = run(poller, idle, 1, options.round_trips)
+            print("%-8s %8d %16.2f" % (poller, idle, per_trip * 1e6))
+
+    print("\nactive throughput: N active connections")
+    print("%-8s %8s %16s" % ("poller", "active", "round trips/s"))
+    for poller in pollers:
+        for active in actives:
+            if poller == "select" and active * 2 + 16 > 1024:
+                continue
+            _, per_second = run(poller, 0, active, options.round_trips)
+            print("%-8s %8d %16.0f" % (poller, active, per_second))
+    IOLoop.configure(None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Benchmark of the multi-process TCPServer modes.
+
+    1. shared: the workers share the listening sockets bound before forking,
+       all of them wake up for a new connection and race to accept it.
+    2. reuseport: every worker binds a SO_REUSEPORT socket of its own, the
+       kernel picks the worker of a connection.
+
+A worker replies its pid and closes the connection. Clients measure the time
+from connect to the reply, and count the connections each worker accepts.
+
+    python reuseport_benchmark.py --workers=4 --clients=16 --connections=20000
+"""
+from __future__ import absolute_import, division, print_function
+
+import env
+import math
+import os
+import signal
+import socket
+import threading
+import time
+
+from nida.ioevent import IOLoop
+from nida.tcpserver import TCPServer
+from nida.options import define, options, parse_command
+
+define("modes", type=str, default="shared,reuseport", help="comma separated "
+       "modes to benchmark")
+define("workers", type=int, default=4, help="worker processes")
+define("clients", type=int, default=16, help="concurrent client threads")
+define("connections", type=int, default=20000, help="connections per mode")
+
+
+class PidServer(TCPServer):
+    def handle_stream(self, stream, addr):
+        stream.write(str(os.getpid()).encode(), stream.close)
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(mode, port, workers):
+    """
+    Fork the server in a process group of its own, return the group id.
+    """
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    os.setpgrp()
+    try:
+        server = PidServer()
+        server.bind(port, address="127.0.0.1",
+                    reuse_port=(mode == "reuseport"))
+        server.start(workers)
+        IOLoop.current().start()
+    finally:
+        os._exit(0)
+
+
+def request(port):
+    """
+    Return (seconds from connect to reply, pid of the worker).
+    """
+    start = time.time()
+    sock = socket.create_connection(("127.0.0.1", port))
+    try:
+        data = b""
+        while True:
+            chunk = sock.recv(64)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return time.time() - start, int(data)
+
+
+def wait_ready(port, workers, timeout=10):
+    """
+    Wait until every worker has accepted a connection, the reuseport workers
+    bind one by one after forking.
+    """
+    seen = set()
+    deadline = time.time() + timeout
+    while len(seen) < workers and time.time() < deadline:
+        try:
+            seen.add(request(port)[1])
+        except socket.error:
+            time.sleep(0.05)
+    return len(seen)
+
+
+def run(mode, workers, clients, connections):
+    """
+    Return (sorted latencies, connections per worker pid, seconds).
+    """
+    port = free_port()
+    pgid = start_server(mode, port, workers)
+    try:
+        ready = wait_ready(port, workers)
+        if ready < workers:
+            print("%s: only %d of %d workers got connections while warming "
+                  "up" % (mode, ready, workers))
+        latencies = []
+        counts = {}
+        lock = threading.Lock()
+        per_client = connections // clients
+
+        def client():
+            mine = []
+            for _ in range(per_client):
+                mine.append(request(port))
+            with lock:
+                for latency, pid in mine:
+                    latencies.append(latency)
+                    counts[pid] = counts.get(pid, 0) + 1
+
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        os.killpg(pgid, signal.SIGTERM)
+        os.waitpid(pgid, 0)
+    latencies.sort()
+    return latencies, counts, elapsed
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def skew(counts, workers):
+    """
+    Return (min, max, coefficient of variation) of connections per worker,
+    workers which got none count as 0.
+    """
+    values = list(counts.values()) + [0] * (workers - len(counts))
+    mean = sum(values) / len(values)
+    stddev = math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+    return min(values), max(values), stddev / mean if mean else 0
+
+
+def main():
+    parse_command()
+    modes = [m for m in options.modes.split(",") if m]
+    if "reuseport" in modes and not hasattr(socket, "SO_REUSEPORT"):
+        print("SO_REUSEPORT is not supported on this platform")
+        modes.remove("reuseport")
+
+    print("%d workers, %d clients, %d connections" %
+          (options.workers, options.clients, options.connections))
+    print("%-10s %8s %8s %8s %8s %8s %8s %6s" %
+          ("mode", "conn/s", "p50 us", "p99 us", "max us",
+           "min/wkr", "max/wkr", "cv"))
+    for mode in modes:
+        latencies, counts, elapsed = run(mode, options.workers,
+                                         options.clients, options.connections)
+        low, high, cv = skew(counts, options.workers)
+        print("%-10s %8.0f %8.0f %8.0f %8.0f %8d %8d %6.3f" %
+              (mode, len(latencies) / elapsed,
+               percentile(latencies, 0.5) * 1e6,
+               percentile(latencies, 0.99) * 1e6, latencies[-1] * 1e6,
+               low, high, cv))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+An HTTPS server and an SSLIOStream client on localhost.
+
+A self-signed certificate for "localhost" is made by the openssl command
+unless --certfile and --keyfile are given. The client checks the server's
+certificate against it and prints the response. Then ``openssl s_client
+-reconnect`` connects six times with one TLS 1.2 session, the reconnects
+must resume it by its session ticket.
+
+    python ssl_server_test.py --port=8443
+"""
+from __future__ import absolute_import, print_function
+import env
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+
+from nida.ioevent import IOLoop
+from nida.iostream import SSLIOStream
+from nida.httpserver import HTTPServer
+from nida.process import Subprocess
+from nida.options import define, options, parse_command
+
+define("port", type=int, default=8443, help="port to listen on")
+define("certfile", type=str, default="", help="certificate, self-signed "
+       "one for localhost made if empty")
+define("keyfile", type=str, default="", help="private key of certfile")
+
+
+def make_self_signed(directory):
+    """
+    Return (certfile, keyfile) of a new self-signed certificate for localhost.
+    """
+    certfile = os.path.join(directory, "localhost.crt")
+    keyfile = os.path.join(directory, "localhost.key")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                           "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                           "-keyout", keyfile, "-out", certfile])
+    return certfile, keyfile
+
+
+def handle_request(request):
+    message = "You requested %s over %s\n" % (request.uri, request.protocol)
+    request.write("HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (
+                  len(message), message))
+    request.finish()
+
+
+def fetch(port, ca_certs, callback):
+    stream = SSLIOStream(socket.socket(), ssl_options={
+        "cert_reqs": ssl.CERT_REQUIRED,
+        "ca_certs": ca_certs,
+    })
+
+    def on_connect():
+        stream.write(b"GET /hello HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        stream.read_until(b"\r\n\r\n", on_headers)
+
+    def on_headers(data):
+        print(data.strip())
+        length = int(data.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+        stream.read_bytes(length, on_body)
+
+    def on_body(data):
+        print(data.strip())
+        stream.close()
+        callback()
+
+    def on_close():
+        if stream.error is not None:
+            print("closed:", repr(stream.error))
+            callback()
+    stream.set_close_callback(on_close)
+    stream.connect(("127.0.0.1", port), on_connect, server_hostname="localhost")
+
+
+def reconnect(port, callback):
+    """
+    Run ``openssl s_client -reconnect`` and call callback with the number of
+    (new, reused) sessions it reports. TLS 1.3 is not used, s_client
+    reconnects before its session ticket arrives.
+    """
+    devnull = open(os.devnull)
+    proc = Subprocess(["openssl", "s_client", "-connect", "127.0.0.1:%d" % port,
+                       "-reconnect", "-tls1_2"], stdin=devnull,
+                      stdout=Subprocess.STREAM, stderr=devnull)
+    devnull.close()
+
+    def on_output(data):
+        lines = data.splitlines()
+        callback(sum(1 for l in lines if l.startswith(b"New,")),
+                 sum(1 for l in lines if l.startswith(b"Reused,")))
+    proc.stdout.read_until_close(on_output)
+
+
+if __name__ == "__main__":
+    parse_command()
+    tempdir = None
+    if options.certfile:
+        certfile, keyfile = options.certfile, options.keyfile or None
+    else:
+        tempdir = tempfile.mkdtemp()
+        certfile, keyfile = make_self_signed(tempdir)
+    try:
+        ioloop = IOLoop.current()
+        server = HTTPServer(handle_request, ssl_options={
+            "certfile": certfile,
+            "keyfile": keyfile,
+        })
+        server.listen(options.port, "127.0.0.1")
+        sessions = []
+
+        def on_reconnect(new, reused):
+            sessions.extend([new, reused])
+            ioloop.stop()
+        ioloop.add_callback(fetch, options.port, certfile,
+                            lambda: reconnect(options.port, on_reconnect))
+        ioloop.start()
+        server.stop()
+        new, reused = sessions
+        print("s_client: %d new, %d reused sessions" % (new, reused))
+        print("server session stats:", server.ssl_session_stats())
+        assert reused > 0, "no session was resumed"
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
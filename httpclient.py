@@ -33,10 +33,10 @@ import functools
 import time
 import weakref
 
-from tornado.concurrent import Future
+from nida.concurrent import Future
 from tornado.escape import utf8
 from tornado import httputil, stack_context
-from tornado.ioloop import IOLoop
+from nida.ioevent import IOLoop
 from tornado.util import Configurable
 
 
@@ -32,7 +32,7 @@ date: 2016.8.20
 """
 
 import socket
-import time
+import ssl
 
 from nida.escape import native_str, parse_qs_bytes
 from nida import httputil
@@ -41,6 +41,7 @@ from nida.log import gen_log
 from nida.util import netutil
 from nida.tcpserver import TCPServer
 from nida import context_manager
+from nida.ioevent import IOLoop
 from nida.util.util import bytes_type
 
 try:
@@ -99,14 +100,19 @@ class HTTPServer(TCPServer):
 
     To make this server serve SSL traffic, send the ``ssl_options`` dictionary
     argument with the arguments required for the `ssl.wrap_socket` method,
-    including ``certfile`` and ``keyfile``.  (In Python 3.2+ you can pass
-    an `ssl.SSLContext` object instead of a dict)::
+    including ``certfile`` and ``keyfile``.  (In Python 2.7.9+ and 3.2+ you
+    can pass an `ssl.SSLContext` object instead of a dict)::
 
        HTTPServer(applicaton, ssl_options={
            "certfile": os.path.join(data_dir, "mydomain.crt"),
            "keyfile": os.path.join(data_dir, "mydomain.key"),
        })
 
+    Returning clients resume their TLS sessions with session tickets, the
+    only resumption offered. Pass ``"session_tickets": False`` to turn them
+    off, see
+    `nida.util.netutil.ssl_options_to_context`.
+
     `HTTPServer` initialization follows one of three patterns (the
     initialization methods are defined on `nida.tcpserver.TCPServer`):
 
@@ -146,18 +152,31 @@ class HTTPServer(TCPServer):
        servers if you want to create your listening sockets in some
        way other than `nida.netutil.bind_sockets`.
 
+    If ``max_header_size`` is given, a connection whose request headers are
+    longer than ``max_header_size`` bytes is closed as soon as that many
+    bytes arrived without the end of headers.
+
+    If ``stream_request_body`` is ``True``, the request callback is run as
+    soon as the headers are parsed and ``request.body`` is left empty; the
+    callback reads the body in chunks with `HTTPRequest.read_body`, so large
+    uploads are handled in constant memory.
+
     """
     def __init__(self, request_callback, no_keep_alive=False, io_loop=None,
-                 xheaders=False, protocol=None, **kwargs):
+                 xheaders=False, protocol=None, max_header_size=None,
+                 stream_request_body=False, **kwargs):
         self.request_callback = request_callback
         self.no_keep_alive = no_keep_alive
         self.xheaders = xheaders
         self.protocol = protocol
+        self.max_header_size = max_header_size
+        self.stream_request_body = stream_request_body
         super(HTTPServer, self).__init__(**kwargs)
 
     def handle_stream(self, stream, address):
         HTTPConnection(stream, address, self.request_callback,
-                       self.no_keep_alive, self.xheaders, self.protocol)
+                       self.no_keep_alive, self.xheaders, self.protocol,
+                       self.max_header_size, self.stream_request_body)
 
 
 class _BadRequestException(Exception):
@@ -172,7 +191,8 @@ class HTTPConnection(object):
     until the HTTP conection is closed.
     """
     def __init__(self, stream, address, request_callback, no_keep_alive=False,
-                 xheaders=False, protocol=None):
+                 xheaders=False, protocol=None, max_header_size=None,
+                 stream_request_body=False):
         self.stream = stream
         self.address = address
         # Save the socket's address family now so we know how to
@@ -183,14 +203,24 @@ class HTTPConnection(object):
         self.no_keep_alive = no_keep_alive
         self.xheaders = xheaders
         self.protocol = protocol
+        self.max_header_size = max_header_size
+        self.stream_request_body = stream_request_body
+        #body bytes not read yet by a streaming request, and whether the
+        #client waits for 100-continue before sending them.
+        self._body_remaining = 0
+        self._body_expect = False
         self._request = None
         self._request_finished = False
         self._write_callback = None
+        # True from a write until its _on_write_complete runs; the stream
+        # may have sent the data already.
+        self._write_pending = False
         self._close_callback = None
         # Save stack context here, outside of any request.  This keeps
         # contexts from one request from leaking into the next.
         self._header_callback = context_manager.wrap(self._on_headers)
-        self.stream.read_until(b"\r\n\r\n", self._header_callback)
+        self.stream.read_until(b"\r\n\r\n", self._header_callback,
+                               max_bytes=self.max_header_size)
 
     def _clear_callbacks(self):
         """Clears the per-request callbacks.
@@ -201,6 +231,7 @@ class HTTPConnection(object):
         facilitate garbage collection in cpython).
         """
         self._write_callback = None
+        self._write_pending = False
         self._close_callback = None
 
     def set_close_callback(self, callback):
@@ -234,16 +265,59 @@ class HTTPConnection(object):
         assert self._request, "Request closed"
         if not self.stream.closed():
             self._write_callback = context_manager.wrap(callback)
+            self._write_pending = True
             self.stream.write(chunk, self._on_write_complete)
 
+    def write_file(self, fileobj, offset=0, count=None, callback=None):
+        """Writes a range of a file to the stream, see
+        `.BaseIOStream.write_file`."""
+        assert self._request, "Request closed"
+        if not self.stream.closed():
+            self._write_callback = context_manager.wrap(callback)
+            self._write_pending = True
+            self.stream.write_file(fileobj, offset, count,
+                                   self._on_write_complete)
+
+    def read_body(self, streaming_callback, callback):
+        """Reads the request body of a streaming request, see
+        `HTTPRequest.read_body`."""
+        assert self._request, "Request closed"
+        if not self._body_remaining or self.stream.closed():
+            IOLoop.current().add_callback(context_manager.wrap(callback))
+            return
+        if self._body_expect:
+            self._body_expect = False
+            self.stream.write(b"HTTP/1.1 100 (Continue)\r\n\r\n")
+        callback = context_manager.wrap(callback)
+
+        def on_body(data):
+            self._body_remaining = 0
+            callback()
+        self.stream.read_bytes(self._body_remaining, on_body,
+                               streaming_callback=streaming_callback)
+
+    def is_write_paused(self):
+        """Returns True if the stream has queued too much output, see
+        `.BaseIOStream.is_write_paused`."""
+        return self.stream.is_write_paused()
+
+    def on_drain(self, callback):
+        """Runs callback once the stream takes more output, see
+        `.BaseIOStream.on_drain`."""
+        if not self.stream.closed():
+            self.stream.on_drain(callback)
+
     def finish(self):
         """Finishes the request."""
         assert self._request, "Request closed"
         self._request_finished = True
-        if not self.stream.writing():
+        # Writes are sent at once when the socket takes them, but their
+        # completion still runs later and must not be cleared.
+        if not self.stream.writing() and not self._write_pending:
             self._finish_request()
 
     def _on_write_complete(self):
+        self._write_pending = False
         if self._write_callback is not None:
             callback = self._write_callback
             self._write_callback = None
@@ -255,7 +329,8 @@ class HTTPConnection(object):
         # there is still data in the IOStream, a future
         # _on_write_complete will be responsible for calling
         # _finish_request.
-        if self._request_finished and not self.stream.writing():
+        if (self._request_finished and not self.stream.writing() and
+                not self._write_pending):
             self._finish_request()
 
     def _finish_request(self):
@@ -272,6 +347,9 @@ class HTTPConnection(object):
                 disconnect = connection_header != "keep-alive"
             else:
                 disconnect = True
+        if self._body_remaining:
+            #the body left unread is in the way of the next request.
+            disconnect = True
         #disconnect = True
         self._request = None
         self._request_finished = False
@@ -283,7 +361,8 @@ class HTTPConnection(object):
             # Use a try/except instead of checking stream.closed()
             # directly, because in some cases the stream doesn't discover
             # that it's closed until you try to read from it.
-            self.stream.read_until(b"\r\n\r\n", self._header_callback)
+            self.stream.read_until(b"\r\n\r\n", self._header_callback,
+                                   max_bytes=self.max_header_size)
         except:
         #except iostream.StreamClosedError:
             self.close()
@@ -313,9 +392,12 @@ class HTTPConnection(object):
                 headers=headers, remote_ip=remote_ip, protocol=self.protocol)
 
             content_length = headers.get("Content-Length")
-            if content_length:
+            if content_length and self.stream_request_body:
+                self._body_remaining = int(content_length)
+                self._body_expect = headers.get("Expect") == "100-continue"
+            elif content_length:
                 content_length = int(content_length)
-                if content_length > self.stream.max_buffer_size:
+                if content_length > self.stream.max_read_buf:
                     raise _BadRequestException("Content-Length too long")
                 if headers.get("Expect") == "100-continue":
                     self.stream.write(b"HTTP/1.1 100 (Continue)\r\n\r\n")
@@ -422,13 +504,10 @@ class HTTPRequest(object):
         # set remote IP and protocol
         self.remote_ip = remote_ip
         if protocol:
-            if protocol == "https":
-                app_log.error("Not support https now")
-                protocol = "http"
             self.protocol = protocol
-        #elif connection and isinstance(connection.stream,
-        #                               iostream.SSLIOStream):
-        #    self.protocol = "https"
+        elif connection and isinstance(connection.stream,
+                                       iostream.SSLIOStream):
+            self.protocol = "https"
         else:
             self.protocol = "http"
 
@@ -449,7 +528,7 @@ class HTTPRequest(object):
         self.host = host or self.headers.get("Host") or "127.0.0.1"
         self.files = files or {}
         self.connection = connection
-        self._start_time = time.time()
+        self._start_time = IOLoop.current().time()
         self._finish_time = None
 
         self.path, sep, self.query = uri.partition('?')
@@ -477,10 +556,34 @@ class HTTPRequest(object):
         assert isinstance(chunk, bytes_type)
         self.connection.write(chunk, callback=callback)
 
+    def write_file(self, fileobj, offset=0, count=None, callback=None):
+        """Writes ``count`` bytes of a file from ``offset`` to the response
+        stream, using sendfile when it is available. The file must stay
+        open until the callback runs."""
+        self.connection.write_file(fileobj, offset, count, callback=callback)
+
+    def is_write_paused(self):
+        """Returns True if the client is slower than the output; stop
+        writing and resume in the `on_drain` callback."""
+        return self.connection.is_write_paused()
+
+    def on_drain(self, callback):
+        """Runs callback once the connection takes more output."""
+        self.connection.on_drain(callback)
+
+    def read_body(self, streaming_callback, callback):
+        """Reads the body of a request to a server with
+        ``stream_request_body``: ``streaming_callback`` is called with each
+        chunk of the body as it arrives, and ``callback`` with no arguments
+        when the body is complete. The next chunk is not read until
+        ``streaming_callback`` returns, call `.BaseIOStream.pause_reading` on
+        ``connection.stream`` in it to wait longer."""
+        self.connection.read_body(streaming_callback, callback)
+
     def finish(self):
         """Finishes this HTTP request on the open connection."""
         self.connection.finish()
-        self._finish_time = time.time()
+        self._finish_time = IOLoop.current().time()
 
     def full_url(self):
         """Reconstructs the full URL for this request."""
@@ -489,35 +592,35 @@ class HTTPRequest(object):
     def request_time(self):
         """Returns the amount of time it took for this request to execute."""
         if self._finish_time is None:
-            return time.time() - self._start_time
+            return IOLoop.current().time() - self._start_time
         else:
             return self._finish_time - self._start_time
 
-    #def get_ssl_certificate(self, binary_form=False):
-    #    """Returns the client's SSL certificate, if any.
-
-    #    To use client certificates, the HTTPServer must have been constructed
-    #    with cert_reqs set in ssl_options, e.g.::
-
-    #        server = HTTPServer(app,
-    #            ssl_options=dict(
-    #                certfile="foo.crt",
-    #                keyfile="foo.key",
-    #                cert_reqs=ssl.CERT_REQUIRED,
-    #                ca_certs="cacert.crt"))
-
-    #    By default, the return value is a dictionary (or None, if no
-    #    client certificate is present).  If ``binary_form`` is true, a
-    #    DER-encoded form of the certificate is returned instead.  See
-    #    SSLSocket.getpeercert() in the standard library for more
-    #    details.
-    #    http://docs.python.org/library/ssl.html#sslsocket-objects
-    #    """
-    #    try:
-    #        return self.connection.stream.socket.getpeercert(
-    #            binary_form=binary_form)
-    #    except ssl.SSLError:
-    #        return None
+    def get_ssl_certificate(self, binary_form=False):
+        """Returns the client's SSL certificate, if any.
+
+        To use client certificates, the HTTPServer must have been constructed
+        with cert_reqs set in ssl_options, e.g.::
+
+            server = HTTPServer(app,
+                ssl_options=dict(
+                    certfile="foo.crt",
+                    keyfile="foo.key",
+                    cert_reqs=ssl.CERT_REQUIRED,
+                    ca_certs="cacert.crt"))
+
+        By default, the return value is a dictionary (or None, if no
+        client certificate is present).  If ``binary_form`` is true, a
+        DER-encoded form of the certificate is returned instead.  See
+        SSLSocket.getpeercert() in the standard library for more
+        details.
+        http://docs.python.org/library/ssl.html#sslsocket-objects
+        """
+        try:
+            return self.connection.stream.socket.getpeercert(
+                binary_form=binary_form)
+        except (ssl.SSLError, AttributeError):
+            return None
 
     def __repr__(self):
         attrs = ("protocol", "host", "method", "uri", "version", "remote_ip",
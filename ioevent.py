@@ -7,27 +7,42 @@ An non-blocking I/O envent module.
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division
 
+import os
+import sys
+import math
 import select
 import threading
 import thread
-import time
 import functools
 import heapq
+import collections
+import itertools
 import errno
 import numbers
 
 from nida import context_manager
-from nida.platform.posix import Waker, set_close_exec
+from nida.platform.posix import Waker, set_close_exec, monotonic_time
 from nida.log import app_log, gen_log
 from nida.util.factory import Factory
 from nida.util.util import get_errno
+from nida.util.stats import Histogram, TIME_BOUNDS, COUNT_BOUNDS
 
 
+class TimeoutError(Exception):
+    pass
+
 class IOLoop(Factory):
     """
     A level-triggered I/O event loop.
 
-    Use epoll in linux and kqueue in BSD/Mac OS X.
+    Use epoll in linux and kqueue in BSD/Mac OS X, and fall back to poll or
+    select where they are not available. A poller backend can be chosen with
+    `IOLoop.configure` or the ``--ioloop-poller`` option before the first
+    IOLoop is created, see `register_poller`. The epoll loop also supports
+    an opt-in edge-triggered mode per fd: add ``IOLoop.EDGE`` to the events of
+    `add_handler`, then the handler is only called when the fd's state changes
+    and it *MUST* read or write until EAGAIN. ``EDGE`` is 0 if the poller does
+    not support it.
     Examples:
         def conn_ready(sock):
             try:
@@ -60,10 +75,22 @@ class IOLoop(Factory):
     READ  = _EPOLLIN
     WRITE = _EPOLLOUT
     ERROR = _EPOLLERR | _EPOLLHUP
+    EDGE  = 0
+
+    #callback priorities, see add_priority_callback.
+    PRIORITY_URGENT     = 0
+    PRIORITY_NORMAL     = 1
+    PRIORITY_BACKGROUND = 2
 
 
     _current = threading.local()
     _thread_lock = threading.Lock()
+    #LoopStats when stats is enabled, see enable_stats.
+    _stats = None
+    #default executor of run_in_executor, created when first used.
+    _executor = None
+    #calls waiting in the queue of the default executor at most.
+    _EXECUTOR_QUEUE = 1024
 
     def __init__(self, *args, **kwargs):
         #instance=False just want known if current instance is none, do not
@@ -77,11 +104,42 @@ class IOLoop(Factory):
 
     @classmethod
     def config_sub(cls):
-        if hasattr(select, "epoll"):
-            return EPollIOLoop
+        for loop_class in _pollers.values():
+            if loop_class.available():
+                return loop_class
+        raise RuntimeError("No poller available")
 
-        if hasattr(select, "kqueue"):
-            return KQueueIOLoop
+    @classmethod
+    def configure(cls, impl):
+        """
+        Choose the IOLoop subclass to create, ``impl`` may be a registered
+        poller name like "epoll", "kqueue", "poll" or "select". None restores
+        the default choice.
+        """
+        if impl is not None and not isinstance(impl, type):
+            if impl not in _pollers:
+                raise ValueError("Unknown poller %r, registered: %s" %
+                                 (impl, ", ".join(_pollers)))
+            impl = _pollers[impl]
+        if impl is not None and not impl.available():
+            raise ValueError("Poller %r is not available" % impl)
+        super(IOLoop, cls).configure(impl)
+
+    @classmethod
+    def available(cls):
+        """
+        Return True if the poller of this class works on this platform.
+        """
+        return True
+
+    @staticmethod
+    def pollers():
+        """
+        Return the names of registered pollers available on this platform, in
+        order of preference.
+        """
+        return [name for name, loop_class in _pollers.items()
+                if loop_class.available()]
 
     @staticmethod
     def instance():
@@ -96,6 +154,21 @@ class IOLoop(Factory):
                     IOLoop._instance = IOLoop()
         return IOLoop._instance
 
+    @staticmethod
+    def clear_instance():
+        """
+        Forget the global and the current instance, the next instance() or
+        current() creates a new IOLoop.
+
+        A forked child calls this to get an IOLoop of its own, the old one is
+        not closed, since its poller is shared with the parent, see
+        `close_forked`.
+        """
+        with IOLoop._thread_lock:
+            if hasattr(IOLoop, "_instance"):
+                del IOLoop._instance
+        IOLoop._current.instance = None
+
     @staticmethod
     def current(instance=True):
         current = getattr(IOLoop._current, "instance", None)
@@ -121,10 +194,42 @@ class IOLoop(Factory):
     def add_callback(self, callback, *args, **kwargs):
         raise NotImplementedError()
 
+    def add_callback_from_signal(self, callback, *args, **kwargs):
+        """
+        Like add_callback, but safe to call from a signal handler: the
+        callback does not capture the interrupted context and the loop is
+        woken up even if it is polling.
+        """
+        raise NotImplementedError()
+
+    def add_priority_callback(self, priority, callback, *args, **kwargs):
+        """
+        Like add_callback, but run the callback in a priority lane. Lanes run
+        in order PRIORITY_URGENT, PRIORITY_NORMAL, PRIORITY_BACKGROUND, and
+        add_callback uses PRIORITY_NORMAL.
+        """
+        raise NotImplementedError()
+
+    def set_budget(self, callbacks=None, timeouts=None, events=None):
+        """
+        Limit the number of callbacks, due timeouts and fd handlers run in one
+        loop iteration, None means no limit. Work over the budget is deferred
+        to the next iteration in the same order, so one flood can not starve
+        the other phases.
+        """
+        raise NotImplementedError()
+
     def add_timeout(self, deadline, callback):
+        """
+        Run callback at the time deadline, return a handle for remove_timeout.
+        """
         raise NotImplementedError()
 
     def remove_timeout(self, timeout):
+        """
+        Cancel a timeout returned by add_timeout, it's safe to cancel a
+        timeout which has run or has been cancelled.
+        """
         raise NotImplementedError()
 
     def start(self):
@@ -133,8 +238,141 @@ class IOLoop(Factory):
     def stop(self):
         pass
 
+    def run_sync(self, func, timeout=None):
+        """
+        Start the loop, run func and stop the loop when func's result is done.
+
+        func returns a `nida.concurrent.Future` or any other result. Return
+        the result or raise the exception of func. If ``timeout`` seconds
+        passed before the result is done, raise `TimeoutError`.
+        """
+        from nida.concurrent import future_from_call
+
+        future_cell = [None]
+
+        def run():
+            future_cell[0] = future_from_call(func)
+            self.add_future(future_cell[0], lambda future: self.stop())
+        self.add_callback(run)
+        if timeout is not None:
+            timeout_handle = self.call_later(timeout, self.stop)
+        self.start()
+        if timeout is not None:
+            self.remove_timeout(timeout_handle)
+        if future_cell[0] is None or not future_cell[0].done():
+            raise TimeoutError("Operation timed out after %s seconds" % timeout)
+        return future_cell[0].result()
+
+    def add_future(self, future, callback):
+        """
+        Call callback with the future on this loop when the future is done.
+        """
+        future.add_done_callback(functools.partial(
+            self._run_future_callback, context_manager.wrap(callback)))
+
+    def _run_future_callback(self, callback, future):
+        #done callbacks run on the current loop, only hop when it's not this
+        #one.
+        if IOLoop.current(instance=False) is self:
+            callback(future)
+        else:
+            self.add_callback(callback, future)
+
+    def run_in_executor(self, executor, fn, *args):
+        """
+        Run fn(*args) in executor and return a `nida.concurrent.Future` of
+        its result, which is set on this loop through add_callback.
+
+        ``executor`` is anything with a ``submit(fn)`` method, like
+        `nida.concurrent.ThreadPoolExecutor` or a `concurrent.futures`
+        executor. If it is None, a default ThreadPoolExecutor is used, at most
+        ``_EXECUTOR_QUEUE`` calls wait in its queue. The exception of a full
+        executor queue is raised here. When stats is
+        enabled, the queue wait and run time are recorded.
+        """
+        from nida.concurrent import Future
+
+        if executor is None:
+            executor = self._default_executor()
+        future = Future()
+        executor.submit(self._run_executor_call, future, monotonic_time(),
+                        fn, args)
+        return future
+
+    def _default_executor(self):
+        if self._executor is None:
+            from nida.concurrent import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(
+                max_queue=self._EXECUTOR_QUEUE)
+        return self._executor
+
+    def _run_executor_call(self, future, submit_time, fn, args):
+        #run in the executor's thread.
+        start = monotonic_time()
+        try:
+            result = fn(*args)
+            exc_info = None
+        except Exception:
+            result = None
+            exc_info = sys.exc_info()
+        self.add_callback(self._set_executor_result, future, result, exc_info,
+                          start - submit_time, monotonic_time() - start)
+
+    def _set_executor_result(self, future, result, exc_info, wait, elapsed):
+        stats = self._stats
+        if stats is not None:
+            stats.record_executor(wait, elapsed)
+        if exc_info is not None:
+            future.set_exc_info(exc_info)
+        else:
+            future.set_result(result)
+
+    def enable_stats(self, slow_callback=None):
+        """
+        Record metrics of every loop iteration, see `stats`.
+
+        If ``slow_callback`` is given, callbacks, timeouts and fd handlers
+        taking more than ``slow_callback`` seconds are logged with a warning.
+        Stats are reset when enabled again. When disabled the loop only pays
+        one attribute check per phase.
+        """
+        self._stats = LoopStats(slow_callback)
+
+    def disable_stats(self):
+        self._stats = None
+
+    def stats(self):
+        """
+        Return a dict of ``counters`` and ``histograms`` recorded since
+        `enable_stats`, None if stats is disabled. Histograms are dicts, see
+        `nida.util.stats.Histogram.to_dict`.
+        """
+        if self._stats is None:
+            return None
+        return self._stats.to_dict()
+
     def time(self):
-        return time.time()
+        """
+        Return the loop's clock in seconds. The clock is monotonic, so it does
+        not jump with the wall clock, it is only comparable with itself and
+        `add_timeout` deadlines *MUST* use it.
+        """
+        return monotonic_time()
+
+    def call_at(self, when, callback, *args, **kwargs):
+        """
+        Run callback at ``when``, a time of `IOLoop.time`. Return a handle for
+        remove_timeout.
+        """
+        return self.add_timeout(when, functools.partial(callback, *args,
+                                                        **kwargs))
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """
+        Run callback after ``delay`` seconds. Return a handle for
+        remove_timeout.
+        """
+        return self.call_at(self.time() + delay, callback, *args, **kwargs)
 
     def split_fd(self, fd):
         try:
@@ -152,10 +390,19 @@ class IOLoop(Factory):
                 gen_log.error("close fd error", exc_info = True)
 
     def _run_callback(self, callback):
-        try:
-            callback()
-        except:
-            self.handle_exception(callback)
+        stats = self._stats
+        if stats is None:
+            try:
+                callback()
+            except:
+                self.handle_exception(callback)
+        else:
+            start = monotonic_time()
+            try:
+                callback()
+            except:
+                self.handle_exception(callback)
+            stats.check_slow(callback, monotonic_time() - start)
 
     def handle_exception(self, callback):
         app_log.error("Exception occured in callback:%s" % callback, exc_info
@@ -164,12 +411,42 @@ class IOLoop(Factory):
     def close(self):
         raise NotImplementedError()
 
+    def close_forked(self):
+        """
+        Close this process' copies of the poller and waker of a loop
+        inherited through fork. The poller is shared with the parent, so no
+        fd is unregistered from it and the handlers' fds are left open.
+        """
+        raise NotImplementedError()
+
 class PollIOLoop(IOLoop):
     """
     I/O event loop through poll.
+
+    Timeouts are kept in a binary heap. Removing from a heap is complicated,
+    so remove_timeout only marks the timeout cancelled in O(1) and counts it,
+    the heap is compacted when cancelled timeouts become the majority, so
+    memory keeps bounded no matter how many timeouts are cancelled.
+
+    The registered events of every fd are cached. update_handler only records
+    the new events, and all changes of an fd before the next poll become at
+    most one modify of the poller, none if the events end up unchanged.
     """
+    #compact the timeouts heap when cancelled timeouts are more than this and
+    #more than half of the heap.
+    _COMPACT_CANCELS = 512
+
     def __init__(self, impl):
+        #clock cached once per iteration when running, see time().
+        self._now           = None
+        #(priority, callback) pairs added since last iteration.
         self._callbacks     = []
+        #callbacks to run, one deque per priority.
+        self._lanes         = (collections.deque(), collections.deque(),
+                               collections.deque())
+        self._callback_budget = None
+        self._timeout_budget  = None
+        self._event_budget    = None
         self._timeouts      = []
         self._due_timeouts  = []
         self._callback_lock = threading.Lock()
@@ -178,7 +455,11 @@ class PollIOLoop(IOLoop):
             set_close_exec(self._impl.fileno())
         self._handlers      = {}
         self._events        = {}
+        #fd -> events registered in poller, and events to modify before poll.
+        self._interests     = {}
+        self._pending_interests = {}
         self._cancels       = 0
+        self._timeout_seq   = itertools.count()
         self._running       = False
         self._stopped       = False
         self._closing       = False
@@ -187,45 +468,113 @@ class PollIOLoop(IOLoop):
         self.add_handler(self._waker.fileno(), lambda fd, event:
                          self._waker.consume(), self.READ)
 
+    def time(self):
+        """
+        When running, return the clock cached at the beginning of this
+        iteration and refreshed after poll, so it costs nothing to call it
+        many times in one iteration.
+        """
+        if self._now is None:
+            return monotonic_time()
+        return self._now
+
     def add_handler(self, fd, handler, events):
         fd_no, fd_obj = self.split_fd(fd)
         self._handlers[fd_no] = (fd_obj, context_manager.wrap(handler))
         self._impl.register(fd_no, events | self.ERROR)
+        self._interests[fd_no] = events | self.ERROR
 
     def update_handler(self, fd, events):
         fd_no, fd_obj = self.split_fd(fd)
-        self._impl.modify(fd_no, events | self.ERROR)
+        self._pending_interests[fd_no] = events | self.ERROR
+        if self._stats is not None:
+            self._stats.counters["update_handler_calls"] += 1
+
+    def _flush_interests(self):
+        """
+        Apply the events changed by update_handler since last poll.
+        """
+        pending = self._pending_interests
+        self._pending_interests = {}
+        stats = self._stats
+        for fd_no, events in pending.items():
+            if self._interests.get(fd_no) == events:
+                continue
+            try:
+                self._impl.modify(fd_no, events)
+            except:
+                gen_log.error("modify fd:%s in IOLoop error" % fd_no,
+                              exc_info = True)
+                continue
+            self._interests[fd_no] = events
+            if stats is not None:
+                stats.counters["poller_modifies"] += 1
 
     def remove_handler(self, fd):
         fd_no, fd_obj = self.split_fd(fd)
         self._handlers.pop(fd_no, None)
         self._events.pop(fd_no, None)
+        self._interests.pop(fd_no, None)
+        self._pending_interests.pop(fd_no, None)
         try:
             self._impl.unregister(fd_no)
         except:
             gen_log.error("remove fd:%s from IOLoop error" % fd_no, exc_info = True)
 
     def add_timeout(self, deadline, callback):
-        timeout = _Timeout(deadline, callback)
+        timeout = _Timeout(deadline, context_manager.wrap(callback),
+                           next(self._timeout_seq))
         heapq.heappush(self._timeouts, timeout)
+        return timeout
 
     def remove_timeout(self, timeout):
-        timeout.callback = None
+        if timeout.callback is not None:
+            timeout.callback = None
+            self._cancels += 1
 
     def add_callback(self, callback, *args, **kwargs):
+        self._add_callback(self.PRIORITY_NORMAL,
+                           functools.partial(context_manager.wrap(callback),
+                                             *args, **kwargs))
+
+    def add_callback_from_signal(self, callback, *args, **kwargs):
+        with context_manager.NullStackContext():
+            self._add_callback(self.PRIORITY_NORMAL,
+                               functools.partial(
+                                   context_manager.wrap(callback),
+                                   *args, **kwargs))
+        #the handler may interrupt a poll which is restarted after it.
+        self._waker.wake()
+
+    def add_priority_callback(self, priority, callback, *args, **kwargs):
+        if priority not in (self.PRIORITY_URGENT, self.PRIORITY_NORMAL,
+                            self.PRIORITY_BACKGROUND):
+            raise ValueError("Unknown callback priority %r" % priority)
+        self._add_callback(priority,
+                           functools.partial(context_manager.wrap(callback),
+                                             *args, **kwargs))
+
+    def _add_callback(self, priority, callback):
         if self._closing:
             return
 
         if self._thread_id != thread.get_ident():
             with self._callback_lock:
                 need_wake = not self._callbacks
-                self._callbacks.append(functools.partial(context_manager.wrap(callback),
-                                                         *args, **kwargs))
+                self._callbacks.append((priority, callback))
                 if need_wake:
                     self._waker.wake()
         else:
-            self._callbacks.append(functools.partial(context_manager.wrap(callback),
-                                                       *args, **kwargs))
+            self._callbacks.append((priority, callback))
+
+    def set_budget(self, callbacks=None, timeouts=None, events=None):
+        self._callback_budget = callbacks
+        self._timeout_budget = timeouts
+        self._event_budget = events
+
+    def _has_ready_callbacks(self):
+        lanes = self._lanes
+        return bool(self._callbacks or lanes[0] or lanes[1] or lanes[2])
 
     def start(self):
         if self._stopped:
@@ -237,52 +586,119 @@ class PollIOLoop(IOLoop):
         self._thread_id = thread.get_ident()
         try:
             while True:
+                self._now = monotonic_time()
+                stats = self._stats
+                if stats is not None:
+                    phase_start = self._now
+
                 with self._callback_lock:
                     callbacks = self._callbacks
                     self._callbacks = []
+                lanes = self._lanes
+                for priority, callback in callbacks:
+                    lanes[priority].append(callback)
 
                 due_timeouts = []
-                now = self.time()
+                #due timeouts over the budget stay in heap for next iteration.
+                timeout_budget = self._timeout_budget
+                now = self._now
                 while self._timeouts:
-                    if _timeouts[0].callback is None:
+                    if self._timeouts[0].callback is None:
                         heapq.heappop(self._timeouts)
-                    elif _timeouts[0].callback <= now:
+                        self._cancels -= 1
+                    elif (timeout_budget is not None and
+                          len(due_timeouts) >= timeout_budget):
+                        break
+                    elif self._timeouts[0].deadline <= now:
                         due_timeouts.append(heapq.heappop(self._timeouts))
                     else:
                         break
+                if (self._cancels > self._COMPACT_CANCELS and
+                        self._cancels > (len(self._timeouts) >> 1)):
+                    self._compact_timeouts()
+
+                #only callbacks added before this iteration are in lanes, new
+                #ones wait for the next iteration.
+                callback_budget = self._callback_budget
+                run_count = 0
+                for lane in lanes:
+                    while lane:
+                        if (callback_budget is not None and
+                                run_count >= callback_budget):
+                            break
+                        run_count += 1
+                        self._run_callback(lane.popleft())
 
-                for callback in callbacks:
-                    self._run_callback(callback)
+                if stats is not None:
+                    phase_end = monotonic_time()
+                    stats.record_callbacks(run_count,
+                                           phase_end - phase_start)
+                    phase_start = phase_end
 
                 for timeout in due_timeouts:
                     if timeout.callback is not None:
-                        self._run_callback(timeout.callback)
+                        callback = timeout.callback
+                        #a run timeout should not be counted when removed.
+                        timeout.callback = None
+                        self._run_callback(callback)
+                    else:
+                        #cancelled after it left the heap, not to compact.
+                        self._cancels -= 1
+
+                if stats is not None:
+                    phase_end = monotonic_time()
+                    stats.record_timeouts(len(due_timeouts),
+                                          phase_end - phase_start)
 
                 #In order to run all callbacks, can not put this code at the
                 #bottom of poll()
                 if not self._running:
                     break
 
-                POLL_TIME = 3600
-                if self._callbacks:
-                    poll_timeout = 0
-                elif self._timeouts:
-                    poll_timeout = self._timeouts[0].deadline - self.time()
-                    poll_timeout = min(poll_timeout,POLL_TIME) 
-                else:
-                    poll_timeout = POLL_TIME
-                
-                try:
-                    fd_event_pairs = self._impl.poll(poll_timeout)
-                except Exception as e:
-                    if get_errno(e) == error.EINTR:
-                        continue
+                if stats is not None:
+                    phase_start = monotonic_time()
+                #events deferred by the budget are handled before polling
+                #again, so every fd of a poll gets its turn.
+                if not self._events:
+                    POLL_TIME = 3600
+                    if self._has_ready_callbacks():
+                        poll_timeout = 0
+                    elif self._timeouts:
+                        #callbacks and timeouts run since the clock was cached
+                        #take time, measure it again or timers fire late.
+                        self._now = monotonic_time()
+                        poll_timeout = self._timeouts[0].deadline - self._now
+                        poll_timeout = max(0, min(poll_timeout,POLL_TIME))
                     else:
-                        raise
-                self._events.update(fd_event_pairs)
+                        poll_timeout = POLL_TIME
+
+                    if self._pending_interests:
+                        self._flush_interests()
+                    try:
+                        fd_event_pairs = self._impl.poll(poll_timeout)
+                    except Exception as e:
+                        if get_errno(e) == errno.EINTR:
+                            continue
+                        else:
+                            raise
+                    self._now = monotonic_time()
+                    if stats is not None:
+                        phase_end = self._now
+                        stats.record_poll(len(fd_event_pairs),
+                                          phase_end - phase_start)
+                        phase_start = phase_end
+                    self._events.update(fd_event_pairs)
+
+                event_budget = self._event_budget
+                handle_count = 0
                 while self._events:
+                    if event_budget is not None and handle_count >= event_budget:
+                        break
+                    handle_count += 1
                     fd_no, event = self._events.popitem()
                     fd_obj, handler = self._handlers[fd_no]
+                    if stats is not None:
+                        handler_start = monotonic_time()
                     try:
                         handler(fd_obj, event)
                     except Exception as e:
@@ -290,49 +706,284 @@ class PollIOLoop(IOLoop):
                             gen_log.debug("broken pipe")
                         else:
                             self.handle_exception(handler)
+                    if stats is not None:
+                        stats.check_slow(handler, monotonic_time() - handler_start)
+
+                if stats is not None:
+                    stats.record_events(monotonic_time() - phase_start)
                 
         finally:
+            self._now = None
             self._stopped = False
             self._running = False
             self._waker.wake()
 
+    def _compact_timeouts(self):
+        self._timeouts = [timeout for timeout in self._timeouts
+                          if timeout.callback is not None]
+        heapq.heapify(self._timeouts)
+        self._cancels = 0
+
     def stop(self):
         self._running = False
         self._stopped = True
         self._waker.wake()
 
     def close(self):
-        for fd_obj, handler in self._handlers.values():
-            self.close_fd(fd_obj)
+        self._closing = True
         self.remove_handler(self._waker.fileno())
+        for fd_obj, handler in list(self._handlers.values()):
+            self.close_fd(fd_obj)
+        self._handlers.clear()
+        self._waker.close()
+        self._impl.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._callbacks = None
+        self._timeouts = None
+
+    def close_forked(self):
+        self._closing = True
+        self._handlers.clear()
+        self._waker.close()
         self._impl.close()
+        #the executor's threads are not running in this process.
+        self._executor = None
         self._callbacks = None
         self._timeouts = None
 
+class LoopStats(object):
+    """
+    Counters and histograms of IOLoop iterations.
+
+    Phases of an iteration are ``callbacks``, ``timeouts``, ``poll`` (the
+    time blocked in poll) and ``events`` (the fd handlers).
+    """
+    def __init__(self, slow_callback=None):
+        self.slow_callback = slow_callback
+        self.counters = {
+            "iterations": 0,
+            "callbacks": 0,
+            "timeouts": 0,
+            "events": 0,
+            "slow_callbacks": 0,
+            "executor_calls": 0,
+            #poller modifies saved = update_handler_calls - poller_modifies
+            "update_handler_calls": 0,
+            "poller_modifies": 0,
+        }
+        self.histograms = {
+            "callbacks_time": Histogram(TIME_BOUNDS),
+            "timeouts_time": Histogram(TIME_BOUNDS),
+            "poll_time": Histogram(TIME_BOUNDS),
+            "events_time": Histogram(TIME_BOUNDS),
+            "callbacks_per_iteration": Histogram(COUNT_BOUNDS),
+            "timeouts_per_iteration": Histogram(COUNT_BOUNDS),
+            "ready_fds": Histogram(COUNT_BOUNDS),
+            "executor_queue_wait": Histogram(TIME_BOUNDS),
+            "executor_run_time": Histogram(TIME_BOUNDS),
+        }
+
+    def record_callbacks(self, count, elapsed):
+        self.counters["iterations"] += 1
+        self.counters["callbacks"] += count
+        self.histograms["callbacks_per_iteration"].add(count)
+        self.histograms["callbacks_time"].add(elapsed)
+
+    def record_timeouts(self, count, elapsed):
+        self.counters["timeouts"] += count
+        self.histograms["timeouts_per_iteration"].add(count)
+        self.histograms["timeouts_time"].add(elapsed)
+
+    def record_poll(self, count, elapsed):
+        self.counters["events"] += count
+        self.histograms["ready_fds"].add(count)
+        self.histograms["poll_time"].add(elapsed)
+
+    def record_events(self, elapsed):
+        self.histograms["events_time"].add(elapsed)
+
+    def record_executor(self, wait, elapsed):
+        self.counters["executor_calls"] += 1
+        self.histograms["executor_queue_wait"].add(wait)
+        self.histograms["executor_run_time"].add(elapsed)
+
+    def check_slow(self, callback, elapsed):
+        if self.slow_callback is not None and elapsed > self.slow_callback:
+            self.counters["slow_callbacks"] += 1
+            gen_log.warning("Slow callback %s took %.3f ms",
+                            _callback_name(callback), elapsed * 1000)
+
+    def to_dict(self):
+        return {
+            "counters": dict(self.counters),
+            "histograms": dict((name, histogram.to_dict()) for name, histogram
+                               in self.histograms.items()),
+        }
+
+def _callback_name(callback):
+    """
+    Find the target of a callback through partials and context wrappers.
+    """
+    while True:
+        if isinstance(callback, functools.partial):
+            callback = callback.func
+        elif hasattr(callback, "__wrapped__"):
+            callback = callback.__wrapped__
+        else:
+            return repr(callback)
+
 class _Timeout(object):
-    __slots__ = ['callback', 'deadline']
+    """
+    A timeout in heap, ordered by deadline then by the adding sequence.
+    """
+    __slots__ = ['callback', 'deadline', 'seq']
     
-    def __init__(self, deadline, callback):
+    def __init__(self, deadline, callback, seq):
         if not isinstance(deadline, numbers.Real):
             raise TypeError("Unsupported deadline %s" % deadline)
-        self._deadline = deadline
-        self._callback = callback
+        self.deadline = deadline
+        self.callback = callback
+        self.seq = seq
 
     def __lt__(self, other):
-        return self._deadline < other._deadline
+        return (self.deadline, self.seq) < (other.deadline, other.seq)
 
     def __le__(self, other):
-        return self._deadline < other._deadline
+        return (self.deadline, self.seq) <= (other.deadline, other.seq)
 
 
 class EPollIOLoop(PollIOLoop):
+    EDGE = getattr(select, "EPOLLET", 0)
+
     def __init__(self, *args, **kwargs):
         return super(EPollIOLoop, self).__init__(select.epoll(), *args, **kwargs)
 
+    @classmethod
+    def available(cls):
+        return hasattr(select, "epoll")
+
 class KQueueIOLoop(PollIOLoop):
     def __init__(self, *args, **kwargs):
         return super(KQueueIOLoop, self).__init__(_KQueue(), *args, **kwargs)
 
+    @classmethod
+    def available(cls):
+        return hasattr(select, "kqueue")
+
+class PollPollIOLoop(PollIOLoop):
+    """
+    A poll(2) loop, O(n) per poll but no limit of fd number.
+    """
+    def __init__(self, *args, **kwargs):
+        return super(PollPollIOLoop, self).__init__(_Poll(), *args, **kwargs)
+
+    @classmethod
+    def available(cls):
+        return hasattr(select, "poll")
+
+class SelectIOLoop(PollIOLoop):
+    """
+    A select(2) loop for restricted environments, only fds less than
+    FD_SETSIZE (usually 1024) can be watched.
+    """
+    def __init__(self, *args, **kwargs):
+        return super(SelectIOLoop, self).__init__(_Select(), *args, **kwargs)
+
+#name -> IOLoop subclass, earlier ones are preferred by IOLoop.config_sub.
+_pollers = collections.OrderedDict()
+
+def register_poller(name, loop_class):
+    """
+    Register an IOLoop subclass as poller backend ``name``, which can be
+    chosen by `IOLoop.configure`. The loop class should override
+    `IOLoop.available`.
+    """
+    if not issubclass(loop_class, IOLoop):
+        raise ValueError("Poller %r is not an IOLoop" % loop_class)
+    _pollers[name] = loop_class
+
+def define_ioloop_options(options=None):
+    """
+    Define IOLoop's options to global namespace. See options module.
+    INPUT:
+        @options, OptionParser : The OptionParser instance.
+    OUTPUT:
+        None
+    """
+    if options is None:
+        from nida.options import options
+    options.define("ioloop_poller", type=str, var="|".join(_pollers),
+                   help="The poller backend of IOLoop, best available "
+                   "default.", callback=IOLoop.configure)
+
+class _Poll(object):
+    """A poll-based poller, timeout of poll is in seconds like epoll."""
+    def __init__(self):
+        self._poll = select.poll()
+
+    def close(self):
+        pass
+
+    def register(self, fd, events):
+        self._poll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, events)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        #round up, or a timeout less than 1ms becomes a busy loop.
+        return self._poll.poll(int(math.ceil(timeout * 1000)))
+
+class _Select(object):
+    """A select-based poller."""
+    def __init__(self):
+        self.read_fds = set()
+        self.write_fds = set()
+        self.error_fds = set()
+
+    def close(self):
+        pass
+
+    def register(self, fd, events):
+        if (fd in self.read_fds or fd in self.write_fds or
+                fd in self.error_fds):
+            raise IOError("fd %s already registered" % fd)
+        if events & IOLoop.READ:
+            self.read_fds.add(fd)
+        if events & IOLoop.WRITE:
+            self.write_fds.add(fd)
+        if events & IOLoop.ERROR:
+            self.error_fds.add(fd)
+            #closed connections are reported as errors by epoll and kqueue,
+            #but as zero-byte reads by select.
+            self.read_fds.add(fd)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self.read_fds.discard(fd)
+        self.write_fds.discard(fd)
+        self.error_fds.discard(fd)
+
+    def poll(self, timeout):
+        readable, writeable, errors = select.select(
+            self.read_fds, self.write_fds, self.error_fds, timeout)
+        events = {}
+        for fd in readable:
+            events[fd] = events.get(fd, 0) | IOLoop.READ
+        for fd in writeable:
+            events[fd] = events.get(fd, 0) | IOLoop.WRITE
+        for fd in errors:
+            events[fd] = events.get(fd, 0) | IOLoop.ERROR
+        return events.items()
+
 class _KQueue(object):
     """A kqueue-based event loop for BSD/Mac systems."""
     def __init__(self):
@@ -386,3 +1037,7 @@ class _KQueue(object):
                 events[fd] = events.get(fd, 0) | IOLoop.ERROR
         return events.items()
 
+register_poller("epoll", EPollIOLoop)
+register_poller("kqueue", KQueueIOLoop)
+register_poller("poll", PollPollIOLoop)
+register_poller("select", SelectIOLoop)
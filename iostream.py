@@ -5,39 +5,189 @@ date: 2016.08.16
 A buffer wrapper for file or socket I/O.
 """
 import collections
+import itertools
+import os
+import re
 import socket
+import ssl
 import errno
 import numbers
 import time
 
 from nida.ioevent import IOLoop
+from nida.platform.posix import set_nonblocking, sendfile, writev
+from nida.util.bufferpool import BufferPool
+from nida.util.netutil import ssl_wrap_socket
 from nida.log import app_log, gen_log
 from nida import  context_manager
 from nida.context_manager import NullStackContext
 
+#the read buffer of a stream which has not borrowed one, never written.
+_NO_BUF = bytearray()
+
 class StreamClosedError(IOError):
     pass
 
+class StreamTimeoutError(IOError):
+    """
+    A stream is closed by its idle, read, write or connect timeout.
+    """
+    pass
+
+class UnsatisfiableReadError(Exception):
+    """
+    A read_until or read_until_regex can not be satisfied within max_bytes.
+    """
+    pass
+
 class BaseIOStream(object):
     """
     Base class for socket or file I/O.
+
+    If ``edge_triggered`` is True and the IOLoop supports it, the fd is
+    registered once for READ and WRITE with ``IOLoop.EDGE`` and never
+    modified, reads and writes are done until EAGAIN on every event. A READ
+    edge with no read pending only marks the fd readable, the data stays in
+    the kernel, so TCP pushes back to the peer like in level-triggered mode,
+    until the next read takes it.
+
+    Read data is kept in one growable bytearray, filled through
+    `read_from_fd_into` at its tail and consumed from its head. Live data is
+    only moved to the front when the tail has no room for another chunk, and
+    callbacks get one copy of exactly the bytes they asked for. The bytearray
+    is borrowed from ``buffer_pool`` and given back once it is empty, so idle
+    streams hold no read buffer; so is the one small writes are joined in.
+
+    ``read_chunk_size`` is the initial size of one read, it adapts between
+    ``min_read_chunk_size`` and ``max_read_chunk_size``: it doubles when a
+    read fills the whole chunk and halves after several reads in a row fill
+    less than a quarter of it. Pass the same value for both bounds to keep it
+    fixed.
+
+    Writes are sent at once when the fd can take them, only the rest is
+    queued. When the queued bytes reach ``write_high_watermark`` the stream is
+    write paused, see `is_write_paused`, until they fall to
+    ``write_low_watermark`` and the `on_drain` callback runs. Producers should
+    stop writing while paused; file ranges from `write_file` are not counted.
+
+    The other way round, `pause_reading` stops reading from the fd so a slow
+    consumer pushes back to the peer through TCP instead of filling the read
+    buffer, until `resume_reading`.
+
+    `read_bytes` and `read_until_close` take a ``streaming_callback`` which
+    gets the data in chunks as they arrive, then the callback is called with
+    no data. Reading is paused while a chunk waits for its streaming callback,
+    so a large body is read in constant memory at the consumer's pace.
+
+    Every stream counts its I/O in a `StreamStats`, see `stats`, and the
+    counts of all streams are summed up as they go, see `total_stats`.
+
+    Timeouts are in seconds, None for no timeout. The stream is closed with a
+    `StreamTimeoutError` in ``self.error`` if nothing is read or written for
+    ``idle_timeout``, if a pending read gets no data for ``read_timeout``, or
+    if queued data can not be written for ``write_timeout``. Activity only
+    records the time, one timer per stream checks the deadlines when it fires
+    and re-arms itself for the next one.
+
+    Read, write, connect and streaming callbacks completed by the fd events
+    of the stream are run at once instead of on the next loop iteration.
+    Operations completed within a call of the user, like a write sent at once
+    or a read served from the buffer, still go through `IOLoop.add_callback`,
+    even if the call is made by a callback run at once, so the caller never
+    reenters. Close callbacks are always run on the next iteration.
     """
+    #read and write buffers are borrowed from this pool.
+    buffer_pool = BufferPool.instance()
+    #number of streams not closed in the process.
+    _open_streams = 0
+    #small reads in a row before read chunk shrinks.
+    _READ_SHRINK_AFTER = 4
+    #read_until_regex searches new data from this many bytes before it.
+    _READ_REGEX_LOOKBACK = 4096
+    #True if write_to_fd_vectored is supported.
+    _vectored_write = False
+    #True if write_file_to_fd is supported.
+    _sendfile = False
+    #at most this number of buffers are written in one vectored write.
+    _WRITE_IOV_MAX = 64
+    #without vectored write, chunks smaller than this are joined before sent.
+    _WRITE_MERGE_SIZE = 4096
+
     def __init__(self, max_read_buf=134217728,
-                 read_chunk_size=4096, write_chunk_size=128 * 1024):
+                 read_chunk_size=4096, write_chunk_size=128 * 1024,
+                 edge_triggered=False, min_read_chunk_size=1024,
+                 max_read_chunk_size=256 * 1024,
+                 write_high_watermark=1024 * 1024,
+                 write_low_watermark=256 * 1024, idle_timeout=None,
+                 read_timeout=None, write_timeout=None):
         self.max_read_buf = max_read_buf
-        self.read_chunk_size = read_chunk_size
+        if min_read_chunk_size > max_read_chunk_size:
+            raise ValueError("min_read_chunk_size is greater than "
+                             "max_read_chunk_size")
+        self.min_read_chunk_size = min_read_chunk_size
+        self.max_read_chunk_size = max_read_chunk_size
+        self.read_chunk_size = min(max(read_chunk_size, min_read_chunk_size),
+                                   max_read_chunk_size)
+        self._read_small_count = 0
         self.write_chunk_size = write_chunk_size
+        if write_low_watermark > write_high_watermark:
+            raise ValueError("write_low_watermark is greater than "
+                             "write_high_watermark")
+        self.write_high_watermark = write_high_watermark
+        self.write_low_watermark = write_low_watermark
         self.ioloop = IOLoop.current()
-        self._read_buf = collections.deque()
+        self._edge_triggered = edge_triggered and bool(self.ioloop.EDGE)
+        #borrowed when first read.
+        self._read_buf = _NO_BUF
+        self._read_buf_pos = 0
         self._write_buf = collections.deque()
+        #bytes of the first write chunk which have been written.
+        self._write_buf_offset = 0
+        #bytes queued in write buffer, not counting file ranges.
+        self._write_buf_size = 0
+        self._write_paused = False
+        #borrowed to join small chunks, given back when write buffer empties.
+        self._write_merge_buf = None
         self._read_buf_size = 0
         #read some bytes or read until a delimiter occur
         self._read_delimiter = None
+        self._read_regex = None
         self._read_bytes = None
         self._read_until_close = False
+        self._read_paused = False
+        #False once a read got EAGAIN, until the next READ edge.
+        self._read_ready = True
+        #bytes from the head of read buffer scanned for the delimiter, and the
+        #limit of read_until.
+        self._read_scanned = 0
+        self._read_max_bytes = None
+        #the exception which closed the stream, if any.
+        self.error = None
+        self._stats = StreamStats()
+        #loop time when data starts waiting in write buffer.
+        self._write_pending_since = None
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self._connect_deadline = None
+        self._timeouts_on = (idle_timeout is not None or
+                             read_timeout is not None or
+                             write_timeout is not None)
+        #the timer and its deadline, and loop time of the last read or
+        #write progress.
+        self._timeout = None
+        self._timeout_deadline = None
+        self._last_read = self._last_write = self.ioloop.time()
+        if idle_timeout is not None:
+            self._arm_timeout(self._last_read + idle_timeout)
+        BaseIOStream._open_streams += 1
 
         self._read_callback = None
+        self._streaming_callback = None
+        #True if reading is paused for a streaming callback, not by user.
+        self._stream_paused = False
         self._write_callback = None
+        self._drain_callback = None
         self._connect_callback = None
         self._close_callback = None
         #for socket 
@@ -45,6 +195,8 @@ class BaseIOStream(object):
 
         self._state = None
         self._closed = False
+        #True while handling fd events, completions found then run inline.
+        self._handling_events = False
 
     def close_fd(self):
         raise NotImplementedError()
@@ -65,18 +217,116 @@ class BaseIOStream(object):
                 callback = self._read_callback
                 self._read_callback = None
                 self._read_until_close = False
-                self._run_callback(callback,
-                                   self._consume(self._read_buf_size))
+                if self._streaming_callback is not None:
+                    if self._read_buf_size:
+                        self._defer_callback(
+                            self._streaming_callback,
+                            self._consume(self._read_buf_size))
+                    self._streaming_callback = None
+                    data = b""
+                else:
+                    data = self._consume(self._read_buf_size)
+                if callback is not None:
+                    self._defer_callback(callback, data)
             if self._close_callback:
                 callback = self._close_callback
                 self._close_callback = None
-                self._run_callback(callback)
+                self._defer_callback(callback)
 
+            self._drain_callback = None
+            if self._timeout is not None:
+                self.ioloop.remove_timeout(self._timeout)
+                self._timeout = None
             if self._state is not None:
                 self.ioloop.remove_handler(self.fileno())
                 self._state = None
             self._closed = True
             self.close_fd()
+            self._release_buffers()
+            if self._write_pending_since is not None:
+                self._record_write_pending()
+            BaseIOStream._open_streams -= 1
+
+    def stats(self):
+        """
+        Return a dict of the I/O counters of this stream, see `StreamStats`.
+        """
+        return self._stats.to_dict()
+
+    @staticmethod
+    def total_stats():
+        """
+        Return a dict of the I/O counters summed up over all the streams of
+        the process, the max counters are the max of any stream, and
+        ``open_streams`` is the number of streams not closed.
+        """
+        stats = _total_stats.to_dict()
+        stats["open_streams"] = BaseIOStream._open_streams
+        return stats
+
+    @staticmethod
+    def reset_total_stats():
+        global _total_stats
+        _total_stats = StreamStats()
+
+    def _arm_timeout(self, deadline):
+        if self._timeout is not None:
+            if self._timeout_deadline <= deadline:
+                #it fires first and re-arms for this one.
+                return
+            self.ioloop.remove_timeout(self._timeout)
+        self._timeout_deadline = deadline
+        with NullStackContext():
+            self._timeout = self.ioloop.add_timeout(deadline, self._on_timeout)
+
+    def _next_deadline(self):
+        """
+        Return the earliest (deadline, name) of the timeouts which apply now,
+        (None, None) if there is none.
+        """
+        deadlines = []
+        if self.idle_timeout is not None:
+            deadlines.append((max(self._last_read, self._last_write) +
+                              self.idle_timeout, "idle"))
+        if self.read_timeout is not None and self.reading():
+            deadlines.append((self._last_read + self.read_timeout, "read"))
+        if self.write_timeout is not None and self._write_buf:
+            deadlines.append((self._last_write + self.write_timeout, "write"))
+        if self._connect_deadline is not None and self._connecting:
+            deadlines.append((self._connect_deadline, "connect"))
+        if not deadlines:
+            return None, None
+        return min(deadlines)
+
+    def _on_timeout(self):
+        self._timeout = None
+        if self._closed:
+            return
+        deadline, name = self._next_deadline()
+        if deadline is None:
+            return
+        if deadline > self.ioloop.time():
+            self._arm_timeout(deadline)
+            return
+        gen_log.info("%s timeout, close fileno:%d" % (name, self.fileno()))
+        self.error = StreamTimeoutError("%s timeout" % name)
+        self.close()
+
+    def _record_write_pending(self):
+        elapsed = self.ioloop.time() - self._write_pending_since
+        self._write_pending_since = None
+        self._stats.write_pending_time += elapsed
+        _total_stats.write_pending_time += elapsed
+
+    def _release_buffers(self):
+        if self._read_buf is not _NO_BUF:
+            self.buffer_pool.release(self._read_buf)
+            self._read_buf = _NO_BUF
+            self._read_buf_pos = 0
+            self._read_buf_size = 0
+        if self._write_merge_buf is not None:
+            self.buffer_pool.release(self._write_merge_buf)
+            self._write_merge_buf = None
 
     def closed(self):
         return self._closed
@@ -85,18 +335,70 @@ class BaseIOStream(object):
         if self._closed:
             return
         if self._state is None:
-            self._state = self.ioloop.ERROR | event
+            if self._edge_triggered:
+                self._state = (self.ioloop.ERROR | self.ioloop.READ |
+                               self.ioloop.WRITE | self.ioloop.EDGE)
+            else:
+                self._state = self.ioloop.ERROR | event
             with NullStackContext():
                 #print 'add io state:%s' % self.fileno()
                 self.ioloop.add_handler(self.fileno(), self.handle_events, self._state)
+        elif self._edge_triggered:
+            return
         elif not self._state & event:
             self._state = event | self._state
             self.ioloop.update_handler(self.fileno(), self._state)
 
 
+    def pause_reading(self):
+        """
+        Stop reading from the fd, reads are only served from the data already
+        buffered until `resume_reading` is called.
+        """
+        #the user takes over a pause made for a streaming callback.
+        self._stream_paused = False
+        if self._read_paused:
+            return
+        self._read_paused = True
+        if (not self._edge_triggered and self._state is not None and
+                self._state & self.ioloop.READ):
+            self._state &= ~self.ioloop.READ
+            self.ioloop.update_handler(self.fileno(), self._state)
+
+    def resume_reading(self):
+        if not self._read_paused:
+            return
+        self._read_paused = False
+        if self._closed or not self._read_pending():
+            return
+        if self.read_timeout is not None:
+            #time paused does not count.
+            self._last_read = self.ioloop.time()
+            self._arm_timeout(self._last_read + self.read_timeout)
+        self._add_io_state(self.ioloop.READ)
+        if self._edge_triggered and self._read_ready:
+            #the edge may have come while paused, try the fd once.
+            with NullStackContext():
+                self.ioloop.add_callback(self._resume_read)
+
+    def is_reading_paused(self):
+        return self._read_paused
+
+    def _resume_read(self):
+        if not self._closed and not self._read_paused:
+            handling = self._handling_events
+            self._handling_events = True
+            try:
+                self._handle_read()
+            finally:
+                self._handling_events = handling
+
     #read 
     def _handle_read(self):
-        while True:
+        while not self._read_paused and not self._closed:
+            if self._edge_triggered and not self._read_pending():
+                #leave the data in kernel until a read is issued.
+                return
             try:
                 res = self._read_to_buf()
             except:
@@ -107,41 +409,142 @@ class BaseIOStream(object):
             if res == 0:
                 break
             else:
-                #if read has completed then return,else loop.
-                if self._read_from_buf():
+                #if read has completed then return,else loop. In edge-triggered
+                #mode a next read pending goes on until EAGAIN, no more event
+                #comes for the bytes left in kernel.
+                if self._read_from_buf() and not self._edge_triggered:
                     return
 
 
     def _read_to_buf(self):
+        end = self._read_buf_pos + self._read_buf_size
+        if len(self._read_buf) - end < self.read_chunk_size:
+            self._reserve_read_buf()
+            end = self._read_buf_size
         try:
-            chunk = self.read_from_fd()
-        except socket.errno, e:
-            if e.arg[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+            #the bytearray is never resized in place, so a view left in a
+            #traceback can not break it.
+            size = self.read_from_fd_into(
+                memoryview(self._read_buf)[end:end + self.read_chunk_size])
+        except (socket.error, OSError), e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
                 return None
             self.close()
             raise
-        if chunk is None:
+        if not size:
+            #None is EAGAIN if the stream is not closed by EOF.
+            eagain = not self._closed
+            if eagain:
+                self._read_ready = False
+            self._stats.record_read(0, eagain, 0)
+            _total_stats.record_read(0, eagain, 0)
             return 0
-        self._read_buf.append(chunk)
-        self._read_buf_size += len(chunk)
+        self._adapt_read_chunk(size)
+        if self._timeouts_on:
+            self._last_read = self.ioloop.time()
+        self._read_buf_size += size
+        self._stats.record_read(size, False, self._read_buf_size)
+        _total_stats.record_read(size, False, self._read_buf_size)
         if self._read_buf_size > self.max_read_buf:
             gen_log.error("Read buffer has overflow")
             self.close()
             raise IOError("Read buffer has overflow")
-        return len(chunk)
+        return size
 
 
+    def _adapt_read_chunk(self, size):
+        chunk_size = self.read_chunk_size
+        if size >= chunk_size:
+            self._read_small_count = 0
+            if chunk_size < self.max_read_chunk_size:
+                self.read_chunk_size = min(chunk_size * 2,
+                                           self.max_read_chunk_size)
+        elif size < chunk_size >> 2:
+            self._read_small_count += 1
+            if (self._read_small_count >= self._READ_SHRINK_AFTER and
+                    chunk_size > self.min_read_chunk_size):
+                self._read_small_count = 0
+                self.read_chunk_size = max(chunk_size >> 1,
+                                           self.min_read_chunk_size)
+        else:
+            self._read_small_count = 0
+
+    def _reserve_read_buf(self):
+        """
+        Make room for a chunk at the tail of read buffer, move the live data
+        to the front if there is enough room, else move it to a bigger one.
+        """
+        pos = self._read_buf_pos
+        size = self._read_buf_size
+        need = size + self.read_chunk_size
+        if pos and len(self._read_buf) >= need:
+            self._read_buf[:size] = self._read_buf[pos:pos + size]
+        else:
+            buf = self.buffer_pool.acquire(max(need, len(self._read_buf) * 2))
+            buf[:size] = memoryview(self._read_buf)[pos:pos + size]
+            if self._read_buf is not _NO_BUF:
+                self.buffer_pool.release(self._read_buf)
+            self._read_buf = buf
+        self._read_buf_pos = 0
+
     def _read_from_buf(self):
+        if self._streaming_callback is not None:
+            return self._read_streaming()
         if self._read_delimiter:
-            _merge_pre_bysize(self._read_buf, self.max_read_buf)
-            loc = self._read_buf[0].find(self._read_delimiter)
+            pos = self._read_buf_pos
+            delimi_len = len(self._read_delimiter)
+            #only search the new bytes, and the tail of scanned bytes in case
+            #the delimiter is split.
+            start = pos + max(0, self._read_scanned - delimi_len + 1)
+            loc = self._read_buf.find(self._read_delimiter, start,
+                                      pos + self._read_buf_size)
             if loc != -1:
+                size = loc - pos + delimi_len
+                if (self._read_max_bytes is not None and
+                        size > self._read_max_bytes):
+                    return self._fail_read("delimiter %r not found within %d "
+                                           "bytes" % (self._read_delimiter,
+                                                      self._read_max_bytes))
                 callback = self._read_callback
-                delimi_len = len(self._read_delimiter)
                 self._read_callback = None
                 self._read_delimiter = None
-                self._run_callback(callback, self._consume(loc + delimi_len))
+                self._read_scanned = 0
+                self._run_callback(callback, self._consume(size))
                 return True
+            self._read_scanned = self._read_buf_size
+            if (self._read_max_bytes is not None and
+                    self._read_scanned >= self._read_max_bytes):
+                return self._fail_read("delimiter %r not found within %d "
+                                       "bytes" % (self._read_delimiter,
+                                                  self._read_max_bytes))
+        elif self._read_regex is not None:
+            pos = self._read_buf_pos
+            #a match ending in the new bytes starts at most lookback bytes
+            #before them unless it is longer, so scanned bytes before that
+            #are not searched again.
+            start = pos + max(0, self._read_scanned -
+                              self._READ_REGEX_LOOKBACK)
+            match = self._read_regex.search(self._read_buf, start,
+                                            pos + self._read_buf_size)
+            if match is not None:
+                size = match.end() - pos
+                if (self._read_max_bytes is not None and
+                        size > self._read_max_bytes):
+                    return self._fail_read("regex %r not matched within %d "
+                                           "bytes" % (self._read_regex.pattern,
+                                                      self._read_max_bytes))
+                callback = self._read_callback
+                self._read_callback = None
+                self._read_regex = None
+                self._read_scanned = 0
+                self._run_callback(callback, self._consume(size))
+                return True
+            self._read_scanned = self._read_buf_size
+            if (self._read_max_bytes is not None and
+                    self._read_buf_size >= self._read_max_bytes):
+                return self._fail_read("regex %r not matched within %d "
+                                       "bytes" % (self._read_regex.pattern,
+                                                  self._read_max_bytes))
         elif self._read_bytes:
             if self._read_buf_size >= self._read_bytes:
                 num_readed = self._read_bytes
@@ -159,10 +562,104 @@ class BaseIOStream(object):
 
         return False
 
+    def _read_streaming(self):
+        """
+        Hand the buffered data to streaming callback, return True when
+        read_bytes has got all the bytes.
+        """
+        size = self._read_buf_size
+        if self._read_bytes is not None:
+            size = min(size, self._read_bytes)
+            self._read_bytes -= size
+        if size:
+            self._run_streaming_callback(self._consume(size))
+        if self._read_bytes is None or self._read_bytes:
+            return False
+        callback = self._read_callback
+        self._read_callback = None
+        self._read_bytes = None
+        self._streaming_callback = None
+        if callback is not None:
+            self._run_callback(callback, b"")
+        return True
+
+    def _run_streaming_callback(self, data):
+        if self._can_run_inline():
+            #the chunk is taken before reading goes on.
+            self._run_callback(self._streaming_callback, data)
+            return
+        if not self._read_paused:
+            #read no more until the consumer has taken this chunk.
+            self.pause_reading()
+            self._stream_paused = True
+        callback = self._streaming_callback
+
+        def wrapper():
+            callback(data)
+            if self._stream_paused:
+                self._stream_paused = False
+                self.resume_reading()
+        self._run_callback(wrapper)
+
+    def _fail_read(self, message):
+        gen_log.info("Unsatisfiable read, close fileno:%d: %s" %
+                     (self.fileno(), message))
+        self._read_callback = None
+        self._read_delimiter = None
+        self._read_regex = None
+        self.error = UnsatisfiableReadError(message)
+        self.close()
+        return True
+
     def read_from_fd(self):
+        """
+        Return a chunk of at most read_chunk_size bytes, None if no data.
+        """
         raise NotImplementedError()
 
+    def read_from_fd_into(self, buf):
+        """
+        Read into the writable buffer buf, return the number of bytes, 0 or
+        None if no data. Subclasses should override it to avoid the copy of
+        read_from_fd.
+        """
+        chunk = self.read_from_fd()
+        if not chunk:
+            return None
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def _can_run_inline(self):
+        return self._handling_events
+
     def _run_callback(self, callback, *args, **kwargs):
+        """
+        Run a completion callback, at once if the stream is handling its fd
+        events, else on the next loop iteration.
+        """
+        if not self._can_run_inline():
+            self._defer_callback(callback, *args, **kwargs)
+            return
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            gen_log.error("Uncatched Exception in:%s, close connection" %
+                          callback, exc_info = True)
+            self.close()
+
+    def _run_user_call(self, fn):
+        """
+        Run fn for a read or write issued by the user, the callbacks it
+        completes are deferred even while handling fd events.
+        """
+        handling = self._handling_events
+        self._handling_events = False
+        try:
+            fn()
+        finally:
+            self._handling_events = handling
+
+    def _defer_callback(self, callback, *args, **kwargs):
         def wrapper():
             try:
                 callback(*args, **kwargs)
@@ -176,46 +673,257 @@ class BaseIOStream(object):
             self.ioloop.add_callback(wrapper)
 
     def _consume(self, size):
-        _merge_pre_bysize(self._read_buf, size)
+        pos = self._read_buf_pos
+        data = memoryview(self._read_buf)[pos:pos + size].tobytes()
         self._read_buf_size -= size
-        return self._read_buf.popleft()
+        if self._read_buf_size:
+            self._read_buf_pos = pos + size
+        else:
+            #an empty buffer goes back to the pool until the next read.
+            self._read_buf_pos = 0
+            self.buffer_pool.release(self._read_buf)
+            self._read_buf = _NO_BUF
+        return data
     #end read
 
     #write process
     def write(self, data, callback = None):
         assert isinstance(data, bytes)
         self.check_close()
-        self._write_buf.append(data)
+        #an empty chunk would never be written, the callback runs once the
+        #data before is.
+        if data:
+            self._write_buf.append(data)
+            self._write_buf_size += len(data)
+            if self._write_buf_size > self._stats.max_write_buf:
+                self._stats.max_write_buf = self._write_buf_size
+                if self._write_buf_size > _total_stats.max_write_buf:
+                    _total_stats.max_write_buf = self._write_buf_size
         if callback is not None:
             self._write_callback = context_manager.wrap(callback)
-        #if not self._connecting:
-        #    self._handle_write()
-        #    if self._write_buf:
-        #        self._add_io_state(self.ioloop.WRITE)
-        self._add_io_state(self.ioloop.WRITE)
+        self._start_write()
+
+    def write_file(self, fileobj, offset=0, count=None, callback=None):
+        """
+        Write ``count`` bytes of a file from ``offset``, all of the rest if
+        count is None, after the data written before.
+
+        fileobj is a file object or a file descriptor, it should not be closed
+        until the callback is called. The file is sent by sendfile(2) when the
+        stream supports it, or read and written a write_chunk_size at a time.
+        """
+        self.check_close()
+        fd = fileobj.fileno() if hasattr(fileobj, "fileno") else fileobj
+        if count is None:
+            count = os.fstat(fd).st_size - offset
+        if count > 0:
+            self._write_buf.append(_FileWrite(fileobj, fd, offset, count))
+        if callback is not None:
+            self._write_callback = context_manager.wrap(callback)
+        self._start_write()
+
+    def _start_write(self):
+        """
+        Write what the fd takes now, and wait for WRITE events only if some
+        data is left. This saves a loop iteration for most small writes.
+        """
+        if not self._connecting:
+            self._run_user_call(self._handle_write)
+            if self._closed:
+                return
+        if self._write_buf_size >= self.write_high_watermark:
+            self._write_paused = True
+        if self._write_buf and self._write_pending_since is None:
+            self._write_pending_since = self.ioloop.time()
+            if self.write_timeout is not None:
+                self._last_write = self._write_pending_since
+                self._arm_timeout(self._last_write + self.write_timeout)
+        if self._write_buf or self._edge_triggered:
+            #WRITE edge only comes when the socket buffer turns writable, so
+            #edge-triggered streams register at once.
+            self._add_io_state(self.ioloop.WRITE)
+
+    def is_write_paused(self):
+        """
+        True if the queued bytes reached the high watermark and have not
+        fallen to the low watermark yet.
+        """
+        return self._write_paused
+
+    def on_drain(self, callback):
+        """
+        Run callback once the write pause ends, on the next loop iteration if
+        the stream is not paused.
+        """
+        if not self._write_paused:
+            self._defer_callback(context_manager.wrap(callback))
+            return
+        self._drain_callback = context_manager.wrap(callback)
 
     def _handle_write(self):
         while self._write_buf:
             try:
-                _merge_pre_bysize(self._write_buf, self.write_chunk_size)
-                bytes_cnt = self.write_to_fd(self._write_buf[0])
+                if self._write_buf[0].__class__ is _FileWrite:
+                    #the file item consumes itself.
+                    if self._write_file(self._write_buf[0]) == 0:
+                        break
+                    continue
+                if self._vectored_write and len(self._write_buf) > 1:
+                    bytes_cnt = self.write_to_fd_vectored(
+                        self._write_bufs(), self._write_buf_offset)
+                else:
+                    bytes_cnt = self.write_to_fd(self._write_data())
+                self._stats.record_write(bytes_cnt, False)
+                _total_stats.record_write(bytes_cnt, False)
                 if bytes_cnt == 0:
                     break
-                _merge_pre_bysize(self._write_buf, bytes_cnt)
-                self._write_buf.popleft()
-            except socket.error, e:
+                if self._timeouts_on:
+                    self._last_write = self.ioloop.time()
+                self._consume_write(bytes_cnt)
+            except (socket.error, OSError), e:
                 if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    self._stats.record_write(0, True)
+                    _total_stats.record_write(0, True)
                     break
                 else:
                     gen_log.error("write error on %d : %s",self.fileno(), e)
                     self.close()
                     return
+        if (self._write_paused and
+                self._write_buf_size <= self.write_low_watermark):
+            self._write_paused = False
+            if self._drain_callback is not None:
+                callback = self._drain_callback
+                self._drain_callback = None
+                self._run_callback(callback)
+                if self._closed:
+                    return
+        if not self._write_buf and self._write_merge_buf is not None:
+            self.buffer_pool.release(self._write_merge_buf)
+            self._write_merge_buf = None
+        if not self._write_buf and self._write_pending_since is not None:
+            self._record_write_pending()
         if not self._write_buf and self._write_callback:
             callback = self._write_callback
             self._write_callback = None
             self._run_callback(callback)
 
-    def write_to_fd(self):
+    def _write_bufs(self):
+        """
+        Return the queued chunks for a vectored write, no copy.
+        """
+        bufs = []
+        for chunk in self._write_buf:
+            if chunk.__class__ is _FileWrite:
+                break
+            bufs.append(chunk)
+            if len(bufs) >= self._WRITE_IOV_MAX:
+                break
+        return bufs
+
+    def _write_data(self):
+        """
+        Return the data for one write: a view of the first chunk, or a view
+        of small chunks joined up to write_chunk_size in the merge buffer.
+        """
+        first = self._write_buf[0]
+        offset = self._write_buf_offset
+        if (len(first) - offset >= self._WRITE_MERGE_SIZE or
+                len(self._write_buf) == 1):
+            if offset:
+                return memoryview(first)[offset:offset +
+                                         self.write_chunk_size]
+            if len(first) > self.write_chunk_size:
+                return memoryview(first)[:self.write_chunk_size]
+            return first
+        merge = self._write_merge_buf
+        if merge is None:
+            merge = self.buffer_pool.acquire(self.write_chunk_size)
+            self._write_merge_buf = merge
+        limit = min(len(merge), self.write_chunk_size)
+        size = min(len(first) - offset, limit)
+        merge[:size] = memoryview(first)[offset:offset + size]
+        for chunk in itertools.islice(self._write_buf, 1, None):
+            if size >= limit or chunk.__class__ is _FileWrite:
+                break
+            #only the head of a chunk which does not fit is joined.
+            n = min(len(chunk), limit - size)
+            merge[size:size + n] = memoryview(chunk)[:n]
+            size += n
+        return memoryview(merge)[:size]
+
+    def _consume_write(self, size):
+        """
+        Drop size bytes written from the head of write buffer.
+        """
+        write_buf = self._write_buf
+        self._write_buf_size -= size
+        while size > 0:
+            remaining = len(write_buf[0]) - self._write_buf_offset
+            if size < remaining:
+                self._write_buf_offset += size
+                return
+            write_buf.popleft()
+            self._write_buf_offset = 0
+            size -= remaining
+
+    def _write_file(self, item):
+        """
+        Send some of a queued file, return the number of bytes sent or moved
+        to the write buffer ahead of it.
+        """
+        if self._sendfile and item.sendfile:
+            try:
+                size = self.write_file_to_fd(item.fd, item.offset,
+                                             min(item.remaining, 1 << 30))
+            except OSError as e:
+                if e.args[0] not in (errno.EINVAL, errno.ENOSYS,
+                                     errno.EOPNOTSUPP):
+                    raise
+                #the file or the fd can not be sendfile'd.
+                item.sendfile = False
+                return self._write_file(item)
+            self._stats.record_write(size, False)
+            _total_stats.record_write(size, False)
+            if size:
+                item.offset += size
+                item.remaining -= size
+                if not item.remaining:
+                    self._write_buf.popleft()
+                return size
+        else:
+            data = _pread(item.fd, min(item.remaining, self.write_chunk_size),
+                          item.offset)
+            if data:
+                item.offset += len(data)
+                item.remaining -= len(data)
+                if not item.remaining:
+                    self._write_buf.popleft()
+                self._write_buf.appendleft(data)
+                self._write_buf_size += len(data)
+                return len(data)
+        gen_log.error("file of fd %d ends before %d bytes are written on %d" %
+                      (item.fd, item.remaining, self.fileno()))
+        self.error = IOError("Unexpected end of file")
+        self.close()
+        return 0
+
+    def write_to_fd(self, data):
+        raise NotImplementedError()
+
+    def write_file_to_fd(self, in_fd, offset, count):
+        """
+        Send count bytes of file in_fd from offset, return the number of
+        bytes sent. Only called if ``_sendfile`` is True.
+        """
+        raise NotImplementedError()
+
+    def write_to_fd_vectored(self, bufs, offset):
+        """
+        Write a list of bytes in one call, from offset of the first one,
+        return the number of bytes written. Only called if ``_vectored_write``
+        is True.
+        """
         raise NotImplementedError()
     #end write process
 
@@ -224,10 +932,13 @@ class BaseIOStream(object):
         if self._closed:
             gen_log.warning("get events from closed stream")
             return
+        handling = self._handling_events
+        self._handling_events = True
         try:
             if self._connecting:
                 self._handle_connect()
             if events & self.ioloop.READ:
+                self._read_ready = True
                 self._handle_read()
             if self._closed:
                 return
@@ -238,6 +949,9 @@ class BaseIOStream(object):
             if events & self.ioloop.ERROR:
                 self.ioloop.add_callback(self.close)
                 return
+            if self._edge_triggered:
+                #interest never changes in edge-triggered mode.
+                return
             state = self.ioloop.ERROR
             if self.reading():
                 state |= self.ioloop.READ
@@ -250,9 +964,15 @@ class BaseIOStream(object):
             gen_log.error("Uncaught exception, close stream", exc_info = True)
             self.close()
             raise
+        finally:
+            self._handling_events = handling
 
     def reading(self):
-        return self._read_callback is not None
+        return self._read_pending() and not self._read_paused
+
+    def _read_pending(self):
+        return (self._read_callback is not None or
+                self._streaming_callback is not None)
 
     def writing(self):
         #write_callback is not Must, so it may always None
@@ -262,9 +982,19 @@ class BaseIOStream(object):
     #read logic process
     def _read_loop(self):
         self.check_close()
+        if self.read_timeout is not None:
+            #a read waits read_timeout from its start.
+            self._last_read = self.ioloop.time()
+            self._arm_timeout(self._last_read + self.read_timeout)
         while True:
             if self._read_from_buf():
                 return
+            if self._read_paused:
+                #served from read buffer only, resume_reading goes on.
+                return
+            if self._edge_triggered and not self._read_ready:
+                #no READ edge since the last EAGAIN, nothing to read.
+                break
             if not self._closed:
                 #this will raise EAGAIN when stream starting cause data hasn't
                 #writed to fd.
@@ -274,11 +1004,17 @@ class BaseIOStream(object):
             return
         self._add_io_state(self.ioloop.READ)
 
-    def read_bytes(self, num, callback=None):
+    def read_bytes(self, num, callback=None, streaming_callback=None):
+        """
+        Call callback with the next num bytes. If streaming_callback is
+        given, it is called with the bytes in chunks as they arrive and
+        callback is called with no data at the end.
+        """
         assert isinstance(num, numbers.Integral)
         self._read_bytes = num
         self._read_callback = context_manager.wrap(callback)
-        self._read_loop()
+        self._streaming_callback = context_manager.wrap(streaming_callback)
+        self._run_user_call(self._read_loop)
         #while True:
         #    if self._read_from_buf():
         #        return
@@ -287,21 +1023,51 @@ class BaseIOStream(object):
         #            break
         #self._add_io_state(self.ioloop.READ)
 
-    def read_until(self, delimiter, callback=None):
+    def read_until(self, delimiter, callback=None, max_bytes=None):
+        """
+        Call callback with the data up to and including the delimiter.
+
+        Each new chunk is only searched once. If the delimiter is not found
+        within ``max_bytes`` bytes, the stream is closed with an
+        `UnsatisfiableReadError` in ``self.error``.
+        """
         self._read_delimiter = delimiter
+        self._read_scanned = 0
+        self._read_max_bytes = max_bytes
+        self._read_callback = context_manager.wrap(callback)
+        self._run_user_call(self._read_loop)
+
+    def read_until_regex(self, regex, callback=None, max_bytes=None):
+        """
+        Call callback with the data up to and including the first match of
+        regex, a pattern or a compiled regular expression of bytes. See
+        read_until for ``max_bytes``.
+
+        Like read_until, each new chunk is searched once, from
+        ``_READ_REGEX_LOOKBACK`` bytes before it, so a match longer than
+        that may be missed when it arrives in pieces.
+        """
+        self._read_regex = re.compile(regex)
+        self._read_scanned = 0
+        self._read_max_bytes = max_bytes
         self._read_callback = context_manager.wrap(callback)
-        self._read_loop()
+        self._run_user_call(self._read_loop)
 
-    def read_until_close(self, callback=None):
+    def read_until_close(self, callback=None, streaming_callback=None):
+        """
+        Call callback with all the data until the stream is closed, see
+        read_bytes for streaming_callback.
+        """
         self._read_callback = context_manager.wrap(callback)
         if self._closed:
             cb = self._read_callback
             self._read_callback = None
-            self._run_callback(cb)
+            self._defer_callback(cb)
             self._read_until_close = False
             return
         self._read_until_close = True
-        self._read_loop()
+        self._streaming_callback = context_manager.wrap(streaming_callback)
+        self._run_user_call(self._read_loop)
     #end read logic process
 
 
@@ -335,11 +1101,38 @@ class IOStream(BaseIOStream):
             return None
         return chunk
 
+    def read_from_fd_into(self, buf):
+        try:
+            size = self.socket.recv_into(buf, len(buf))
+        except socket.error, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return None
+            else:
+                raise
+        if not size:
+            self.close()
+            return None
+        return size
+
     def write_to_fd(self, data):
-        gen_log.debug("in write_to_fd")
         return self.socket.send(data)
 
-    def connect(self, address, callback):
+    _vectored_write = writev is not None
+
+    def write_to_fd_vectored(self, bufs, offset):
+        return writev(self.socket.fileno(), bufs, offset)
+
+    _sendfile = sendfile is not None
+
+    def write_file_to_fd(self, in_fd, offset, count):
+        return sendfile(self.socket.fileno(), in_fd, offset, count)
+
+    def connect(self, address, callback, timeout=None):
+        """
+        Connect the socket to address and run callback once connected. If it
+        is not connected in ``timeout`` seconds, the stream is closed with a
+        `StreamTimeoutError`.
+        """
         try:
             self.socket.connect(address)
         except socket.error as e:
@@ -350,34 +1143,283 @@ class IOStream(BaseIOStream):
                 return
         self._connect_callback = context_manager.wrap(callback)
         self._connecting = True
+        if timeout is not None:
+            self._connect_deadline = self.ioloop.time() + timeout
+            self._arm_timeout(self._connect_deadline)
         self._add_io_state(self.ioloop.WRITE)
 
     def _handle_connect(self):
+        self._connecting = False
         if self._connect_callback is not None:
             callback = self._connect_callback
             self._connect_callback = None
             self._run_callback(callback)
-        self._connecting = False
+
+
+class SSLIOStream(IOStream):
+    """
+    An IOStream over SSL/TLS.
+
+    A server passes a socket wrapped with ``do_handshake_on_connect=False``,
+    the handshake is done as the fd gets ready, WANT_READ and WANT_WRITE set
+    the interest; reads and writes are held until it completes. A client
+    passes a plain socket and the ``ssl_options`` keyword argument, an
+    SSLContext or a dict for `nida.util.netutil.ssl_wrap_socket`, the socket
+    is wrapped when `connect` succeeds. The default client options verify
+    the server's certificate against the system CA certificates.
+    """
+    #SSL records can not be written by writev or sendfile.
+    _vectored_write = False
+    _sendfile = False
+
+    def __init__(self, *args, **kwargs):
+        self._ssl_options = kwargs.pop("ssl_options", None)
+        super(SSLIOStream, self).__init__(*args, **kwargs)
+        self._ssl_accepting = True
+        self._handshake_reading = False
+        self._handshake_writing = False
+        self._ssl_connect_callback = None
+        self._server_hostname = None
+        if isinstance(self.socket, ssl.SSLSocket):
+            #a server side socket, the handshake starts at once.
+            self._add_io_state(self.ioloop.WRITE)
+
+    def reading(self):
+        return self._handshake_reading or super(SSLIOStream, self).reading()
+
+    def writing(self):
+        return self._handshake_writing or super(SSLIOStream, self).writing()
+
+    def _do_ssl_handshake(self):
+        self._handshake_reading = False
+        self._handshake_writing = False
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError as e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self._handshake_reading = True
+                return
+            elif e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self._handshake_writing = True
+                return
+            elif _is_ssl_eof(e):
+                return self.close()
+            gen_log.warning("SSL handshake error on fd %d: %s",
+                            self.fileno(), e)
+            self.error = e
+            return self.close()
+        except socket.error as e:
+            if e.args[0] in (errno.ECONNABORTED, errno.ECONNRESET,
+                             errno.EPIPE, errno.ENOTCONN, errno.EBADF):
+                return self.close()
+            raise
+        self._ssl_accepting = False
+        if not self._verify_cert():
+            return self.close()
+        if self._ssl_connect_callback is not None:
+            callback = self._ssl_connect_callback
+            self._ssl_connect_callback = None
+            self._run_callback(callback)
+
+    def _verify_cert(self):
+        """
+        Check the server's hostname for a client whose context does not.
+        """
+        context = getattr(self.socket, "context", None)
+        if (self._server_hostname is None or context is None or
+                context.verify_mode == ssl.CERT_NONE or
+                getattr(context, "check_hostname", False)):
+            return True
+        try:
+            ssl.match_hostname(self.socket.getpeercert(),
+                               self._server_hostname)
+        except ssl.CertificateError as e:
+            gen_log.warning("Invalid SSL certificate on fd %d: %s",
+                            self.fileno(), e)
+            self.error = e
+            return False
+        return True
+
+    def _handle_read(self):
+        if self._ssl_accepting:
+            self._do_ssl_handshake()
+            if self._ssl_accepting or self._closed:
+                return
+        super(SSLIOStream, self)._handle_read()
+
+    def _handle_write(self):
+        if self._ssl_accepting:
+            self._do_ssl_handshake()
+            if self._ssl_accepting or self._closed:
+                return
+        super(SSLIOStream, self)._handle_write()
+
+    def connect(self, address, callback, timeout=None, server_hostname=None):
+        """
+        Connect and do the handshake, then run callback. server_hostname is
+        sent by SNI and the certificate is checked against it, it is the host
+        of address by default.
+        """
+        self._ssl_connect_callback = context_manager.wrap(callback)
+        if server_hostname is None and isinstance(address, tuple):
+            server_hostname = address[0]
+        self._server_hostname = server_hostname
+        super(SSLIOStream, self).connect(address, None, timeout)
+
+    def _handle_connect(self):
+        if self._ssl_options is None:
+            self._ssl_options = ssl.create_default_context()
+        self.socket = ssl_wrap_socket(self.socket, self._ssl_options,
+                                      server_hostname=self._server_hostname,
+                                      do_handshake_on_connect=False)
+        super(SSLIOStream, self)._handle_connect()
+
+    def read_from_fd_into(self, buf):
+        if self._ssl_accepting:
+            return None
+        try:
+            size = self.socket.recv_into(buf, len(buf))
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ,
+                             ssl.SSL_ERROR_WANT_WRITE):
+                return None
+            elif _is_ssl_eof(e):
+                self.close()
+                return None
+            raise
+        except socket.error as e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return None
+            raise
+        if not size:
+            self.close()
+            return None
+        return size
+
+    def write_to_fd(self, data):
+        if self._ssl_accepting:
+            return 0
+        try:
+            return self.socket.send(data)
+        except ssl.SSLError as e:
+            #OpenSSL takes the same bytes again, even from a moved buffer.
+            if e.args[0] in (ssl.SSL_ERROR_WANT_WRITE,
+                             ssl.SSL_ERROR_WANT_READ):
+                return 0
+            raise
+
+    def session_reused(self):
+        """
+        True if the handshake resumed a session, None if it is unknown
+        (python 2, see `nida.tcpserver.TCPServer.ssl_session_stats` for the
+        server side) or the handshake has not completed.
+        """
+        if self._ssl_accepting or self._closed:
+            return None
+        return getattr(self.socket, "session_reused", None)
 
 
 class PipeIOStream(BaseIOStream):
-    pass
+    """
+    A pipe fd IOStream wrapper, the fd is set non-blocking and closed with
+    the stream. One end of os.pipe() or a subprocess stdio pipe only reads or
+    writes, so only the matching methods should be used.
+    """
+    def __init__(self, fd, *args, **kwargs):
+        self.fd = fd
+        set_nonblocking(fd)
+        super(PipeIOStream, self).__init__(*args, **kwargs)
+
+    def fileno(self):
+        return self.fd
+
+    def close_fd(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+        self.fd = None
+
+    def read_from_fd(self):
+        try:
+            chunk = os.read(self.fd, self.read_chunk_size)
+        except OSError, e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return None
+            raise
+        if not chunk:
+            self.close()
+            return None
+        return chunk
 
-def _merge_pre_bysize(deque, size):
-    if len(deque) == 1 and len(deque[0]) <= size:
-        return
-    prefix = []
-    remaining = size
-    while deque and remaining > 0:
-        chunk = deque.popleft()
-        if len(chunk) > remaining:
-            deque.appendleft(chunk[remaining:])
-            chunk = chunk[:remaining]
-        prefix.append(chunk)
-        remaining -= len(chunk)
-    if prefix:
-        deque.appendleft(''.join(prefix))
-        #deque.appendleft(type(prefix[0])().join(prefix))
-    if not deque:
-        deque.appendleft(b"")
+    def write_to_fd(self, data):
+        return os.write(self.fd, data)
+
+    _vectored_write = writev is not None
+
+    def write_to_fd_vectored(self, bufs, offset):
+        return writev(self.fd, bufs, offset)
+
+
+class StreamStats(object):
+    """
+    I/O counters of a stream: bytes and calls of reads and writes, the calls
+    which got EAGAIN, the max bytes in read and write buffer, and the seconds
+    spent with data waiting in write buffer.
+    """
+    __slots__ = ['bytes_read', 'bytes_written', 'read_calls', 'write_calls',
+                 'read_eagain', 'write_eagain', 'max_read_buf',
+                 'max_write_buf', 'write_pending_time']
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def record_read(self, size, eagain, buffered):
+        self.read_calls += 1
+        if eagain:
+            self.read_eagain += 1
+        self.bytes_read += size
+        if buffered > self.max_read_buf:
+            self.max_read_buf = buffered
+
+    def record_write(self, size, eagain):
+        self.write_calls += 1
+        if eagain:
+            self.write_eagain += 1
+        self.bytes_written += size
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+#the counters of all streams.
+_total_stats = StreamStats()
+
+
+class _FileWrite(object):
+    """
+    A file range queued in the write buffer, see BaseIOStream.write_file.
+    """
+    __slots__ = ['fileobj', 'fd', 'offset', 'remaining', 'sendfile']
+
+    def __init__(self, fileobj, fd, offset, count):
+        self.fileobj = fileobj
+        self.fd = fd
+        self.offset = offset
+        self.remaining = count
+        self.sendfile = True
+
+def _is_ssl_eof(e):
+    """
+    True if an SSLError means the peer has closed the connection, with or
+    without close_notify. OpenSSL 3 reports the latter as an SSL error.
+    """
+    if e.args[0] in (ssl.SSL_ERROR_EOF, ssl.SSL_ERROR_ZERO_RETURN):
+        return True
+    return "unexpected eof" in str(e).lower()
 
+def _pread(fd, size, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
@@ -24,6 +24,7 @@ import sys
 import os
 from nida.util.util import string_compatible,Error
 from nida.log import define_logging_options
+from nida.ioevent import define_ioloop_options
 
 class OptionParser(object):
     """A Dictionary of options.
@@ -286,3 +287,4 @@ def add_parse_callback(callback):
 options = OptionParser()
 
 define_logging_options(options)
+define_ioloop_options(options)
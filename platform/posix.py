@@ -6,39 +6,206 @@ System call wrapper for posix.
 from __future__ import absolute_import, division
 
 import os
+import sys
 import fcntl
+import struct
+import time
 
 def set_close_exec(fd):
     flags = fcntl.fcntl(fd, fcntl.F_GETFD)
     fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 
-def _set_nonblocking(fd):
+def set_nonblocking(fd):
     flags = fcntl.fcntl(fd, fcntl.F_GETFL)
     fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
-class Waker(object):
+#eventfd flags from <sys/eventfd.h>, same as O_NONBLOCK and O_CLOEXEC on linux.
+_EFD_NONBLOCK = 0o4000
+_EFD_CLOEXEC  = 0o2000000
+
+def _load_eventfd():
+    """
+    Return a function to create a nonblocking close-on-exec eventfd, None if
+    eventfd is not available.
+    """
+    if hasattr(os, "eventfd"):
+        return lambda: os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc_eventfd = libc.eventfd
+    except (OSError, AttributeError):
+        return None
+
+    def eventfd():
+        fd = libc_eventfd(0, _EFD_NONBLOCK | _EFD_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return fd
+    return eventfd
+
+_eventfd = _load_eventfd()
+
+#clock id from <time.h> on linux.
+_CLOCK_MONOTONIC = 1
+
+def _load_monotonic():
+    """
+    Return a monotonic clock function in seconds, fall back to time.time if
+    there is no monotonic clock.
+    """
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    if not sys.platform.startswith("linux"):
+        return time.time
+    try:
+        import ctypes
+        import ctypes.util
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1",
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        #the call releases the GIL, a shared timespec would be torn by
+        #another thread.
+        spec = timespec()
+        if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+monotonic_time = _load_monotonic()
+
+def _load_libc():
+    """
+    Return libc through ctypes, None if it can not be loaded.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+    except OSError:
+        return None
+
+def _load_writev():
+    """
+    Return a function writev(fd, bufs, offset) which writes a list of bytes
+    in one call, skipping the first offset bytes of the first one, and
+    returns the number of bytes written. None if writev is not available.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    libc = _load_libc()
+    if libc is None or not hasattr(libc, "writev"):
+        return None
+    import ctypes
+
+    class iovec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p),
+                    ("iov_len", ctypes.c_size_t)]
+
+    libc_writev = libc.writev
+    libc_writev.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int]
+    libc_writev.restype = ctypes.c_ssize_t
+
+    def writev(fd, bufs, offset=0):
+        iov = (iovec * len(bufs))()
+        for i, buf in enumerate(bufs):
+            #the address of the bytes themselves, no copy. bufs keeps them
+            #alive during the call.
+            iov[i].iov_base = ctypes.cast(buf, ctypes.c_void_p).value
+            iov[i].iov_len = len(buf)
+        iov[0].iov_base += offset
+        iov[0].iov_len -= offset
+        size = libc_writev(fd, iov, len(bufs))
+        if size < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return size
+    return writev
+
+def _load_sendfile():
+    """
+    Return a function sendfile(out_fd, in_fd, offset, count) like
+    os.sendfile of python 3, None if sendfile is not available.
+    """
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    #the BSD sendfile takes other arguments.
+    if not sys.platform.startswith("linux"):
+        return None
+    libc = _load_libc()
+    if libc is None:
+        return None
+    import ctypes
+    #sendfile64 takes a 64 bits offset on 32 bits platforms too.
+    libc_sendfile = getattr(libc, "sendfile64", None) or getattr(
+        libc, "sendfile", None)
+    if libc_sendfile is None:
+        return None
+    libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc_sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        off = ctypes.c_int64(offset)
+        size = libc_sendfile(out_fd, in_fd, ctypes.byref(off), count)
+        if size < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return size
+    return sendfile
+
+writev = _load_writev()
+sendfile = _load_sendfile()
+
+class PipeWaker(object):
     """
     To wake up I/O block.
+
+    A burst of wake() only writes once until the loop consume() it, the
+    ``_woken`` flag is a plain attribute so no lock is needed.
     """
     def __init__(self):
         r, w = os.pipe()
-        _set_nonblocking(r)
-        _set_nonblocking(w)
+        set_nonblocking(r)
+        set_nonblocking(w)
         set_close_exec(r)
         set_close_exec(w)
         self.reader = os.fdopen(r, "rb", 0)
         self.writer = os.fdopen(w, "wb", 0)
+        self._woken = False
 
     def fileno(self):
         return self.reader.fileno()
 
     def wake(self):
+        if self._woken:
+            return
+        self._woken = True
         try:
             self.writer.write(b"x")
         except IOError:
             pass
 
     def consume(self):
+        #drain before clearing the flag, or the byte of a wake() in between is
+        #drained while the flag stays set, and no later wake() writes again.
+        #a wake() folded in here is seen, the loop reads the callbacks after.
         try:
             while True:
                 res = self.reader.read()
@@ -46,9 +213,48 @@ class Waker(object):
                     break
         except IOError:
             pass
+        self._woken = False
 
     def close(self):
         self.reader.close()
         self.writer.close()
 
+class EventFdWaker(object):
+    """
+    To wake up I/O block through a linux eventfd, one fd and one 8 bytes
+    counter instead of a pipe pair. Wakes are coalesced like `PipeWaker`.
+    """
+    _ONE = struct.pack("Q", 1)
+
+    def __init__(self):
+        self._fd = _eventfd()
+        self._woken = False
+
+    def fileno(self):
+        return self._fd
+
+    def wake(self):
+        if self._woken:
+            return
+        self._woken = True
+        try:
+            os.write(self._fd, self._ONE)
+        except OSError:
+            pass
+
+    def consume(self):
+        #drain first, see PipeWaker.consume.
+        try:
+            #one read resets the whole counter.
+            os.read(self._fd, 8)
+        except OSError:
+            pass
+        self._woken = False
+
+    def close(self):
+        os.close(self._fd)
 
+if _eventfd is not None:
+    Waker = EventFdWaker
+else:
+    Waker = PipeWaker
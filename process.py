@@ -7,16 +7,23 @@ Make nida has multiple processes ability.
 
 from __future__ import absolute_import
 
+import errno
 import os
 import multiprocessing
 import signal
+import subprocess
+import sys
 
+from nida import context_manager
+from nida.ioevent import IOLoop
+from nida.iostream import PipeIOStream
 from nida.log import gen_log
+from nida.platform.posix import set_close_exec
 
 
 def cpu_count():
     try:
-        return multiprocessing.cpu_count
+        return multiprocessing.cpu_count()
     except:
         gen_log.error("Can not detect number of processors, return 1")
     return 1
@@ -24,8 +31,16 @@ def cpu_count():
 _task_id = None
 
 def fork(num, max_tries=20):
+    """
+    Fork num child processes (cpu_count() if num is None or <= 0) and return
+    the task id of the child in it, 0 to num - 1. The parent never returns, it
+    waits for the children and restarts one which dies abnormally, at most
+    max_tries times, and exits when all of them exit normally.
+    """
     global _task_id
     assert _task_id is None
+    num_processes = num
+    max_restarts = max_tries
     if num_processes is None or num_processes <= 0:
         num_processes = cpu_count()
     gen_log.info("Starting %d processes", num_processes)
@@ -74,4 +89,137 @@ def fork(num, max_tries=20):
     sys.exit(0)
 
 
+class Subprocess(object):
+    """
+    Wraps subprocess.Popen with IOStream support.
 
+    The constructor takes the same arguments as subprocess.Popen, pass
+    ``Subprocess.STREAM`` for stdin, stdout or stderr to get that pipe as a
+    `PipeIOStream` on the attribute of the same name, other values are passed
+    through and the attributes are those of the Popen object.
+
+    Use `set_exit_callback` to get the return code without blocking, the
+    children are reaped by a SIGCHLD handler set on first use for the whole
+    process, see `initialize`.
+    """
+    STREAM = object()
+
+    _initialized = False
+    _old_sigchld = None
+    #pid -> Subprocess which waits for exit.
+    _waiting = {}
+
+    def __init__(self, *args, **kwargs):
+        self.ioloop = IOLoop.current()
+        #the child ends of the pipes, closed in parent once forked.
+        to_close = []
+        for name in ("stdin", "stdout", "stderr"):
+            if kwargs.get(name) is not Subprocess.STREAM:
+                continue
+            r, w = os.pipe()
+            #the child must not inherit the parent ends, or it never sees
+            #EOF on its stdin.
+            set_close_exec(w if name == "stdin" else r)
+            if name == "stdin":
+                kwargs[name] = r
+                to_close.append(r)
+                setattr(self, name, PipeIOStream(w))
+            else:
+                kwargs[name] = w
+                to_close.append(w)
+                setattr(self, name, PipeIOStream(r))
+        try:
+            self.proc = subprocess.Popen(*args, **kwargs)
+        except:
+            for fd in to_close:
+                os.close(fd)
+            for name in ("stdin", "stdout", "stderr"):
+                stream = self.__dict__.get(name)
+                if stream is not None:
+                    stream.close()
+            raise
+        for fd in to_close:
+            os.close(fd)
+        for name in ("stdin", "stdout", "stderr"):
+            if name not in self.__dict__:
+                setattr(self, name, getattr(self.proc, name))
+        self.pid = self.proc.pid
+        self.returncode = None
+        self._exit_callback = None
+
+    def set_exit_callback(self, callback):
+        """
+        Run callback with the return code when the process exits, a negative
+        return code -N means the process is killed by signal N. If the process
+        is reaped by someone else, the return code is the one Popen got, None
+        if it is unknown.
+
+        The callback is run on the IOLoop of the Subprocess, and the process
+        is not reaped by subprocess module any more.
+        """
+        self._exit_callback = context_manager.wrap(callback)
+        Subprocess.initialize()
+        Subprocess._waiting[self.pid] = self
+        #the process may have exited before the handler is set.
+        Subprocess._try_cleanup_process(self.pid)
+
+    @classmethod
+    def initialize(cls):
+        """
+        Set the SIGCHLD handler, it is run on the current IOLoop. This is
+        done by set_exit_callback, call it beforehand to choose the IOLoop.
+        """
+        if cls._initialized:
+            return
+        ioloop = IOLoop.current()
+
+        def handler(sig, frame):
+            ioloop.add_callback_from_signal(cls._cleanup)
+        cls._old_sigchld = signal.signal(signal.SIGCHLD, handler)
+        cls._initialized = True
+
+    @classmethod
+    def uninitialize(cls):
+        """
+        Restore the SIGCHLD handler before initialize.
+        """
+        if not cls._initialized:
+            return
+        signal.signal(signal.SIGCHLD, cls._old_sigchld)
+        cls._initialized = False
+
+    @classmethod
+    def _cleanup(cls):
+        for pid in list(cls._waiting):
+            cls._try_cleanup_process(pid)
+
+    @classmethod
+    def _try_cleanup_process(cls, pid):
+        try:
+            ret_pid, status = os.waitpid(pid, os.WNOHANG)
+        except OSError as e:
+            if e.args[0] != errno.ECHILD:
+                raise
+            #reaped by someone else, like Popen.wait which keeps the code.
+            subproc = cls._waiting.pop(pid, None)
+            if subproc is not None:
+                subproc.ioloop.add_callback(subproc._set_returncode, None)
+            return
+        if ret_pid == 0:
+            return
+        subproc = cls._waiting.pop(pid)
+        subproc.ioloop.add_callback(subproc._set_returncode, status)
+
+    def _set_returncode(self, status):
+        if status is None:
+            self.returncode = self.proc.returncode
+        elif os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        #so that Popen does not wait for it again.
+        self.proc.returncode = self.returncode
+        if self._exit_callback is not None:
+            callback = self._exit_callback
+            self._exit_callback = None
+            callback(self.returncode)
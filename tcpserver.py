@@ -11,9 +11,10 @@ import os
 import errno
 import socket
 
-from nida.iostream import IOStream
+from nida.iostream import IOStream, SSLIOStream
 from nida.ioevent import IOLoop
-from nida.util.netutil import _DEFAULT_BACKLOG, bind_listen
+from nida.util.netutil import (_DEFAULT_BACKLOG, bind_listen,
+                               ssl_options_to_context, ssl_wrap_socket)
 from nida.log import gen_log, app_log
 from nida import process
 
@@ -22,27 +23,87 @@ class TCPServer(object):
     """
     a nonblocking, single-thread TCP Server.
     
-    Not supported ssl and ipv6 now.
+    Not supported ipv6 now.
+
+    If ``edge_triggered`` is True, the connection streams use the IOLoop's
+    edge-triggered mode when it is available, see `IOLoop.EDGE`.
+
+    If ``idle_timeout`` is given, a connection with nothing read or written
+    for that many seconds is closed, see `BaseIOStream`.
+
+    To serve SSL/TLS, pass ``ssl_options``, an `ssl.SSLContext` or a dict for
+    `nida.util.netutil.ssl_options_to_context`::
+
+        TCPServer(ssl_options={
+            "certfile": os.path.join(data_dir, "mydomain.crt"),
+            "keyfile": os.path.join(data_dir, "mydomain.key"),
+        })
+
+    The context is built once, so all connections share its ticket keys and
+    session cache and returning clients resume their sessions, see
+    `ssl_session_stats`. Connections are then `SSLIOStream` and their
+    handshake is done in the IOLoop.
+
+    A multi-process server binds before `start`, the forked children share
+    the listening sockets and all of them wake up for a new connection::
+
+        server.bind(8888)
+        server.start(0)   #one process per cpu
+        IOLoop.current().start()
+
+    With ``bind(port, reuse_port=True)`` every child binds a SO_REUSEPORT
+    socket of its own on the port instead, the kernel spreads the
+    connections over the children, and only the chosen one wakes up.
+    Forked children create their own IOLoop in `start`, so do not start the
+    IOLoop before forking.
     """
-    def __init__(self, backlog=_DEFAULT_BACKLOG, ioloop=None):
+    def __init__(self, backlog=_DEFAULT_BACKLOG, ioloop=None,
+                 edge_triggered=False, idle_timeout=None, ssl_options=None):
         self.ioloop           = ioloop or IOLoop.current()
         self._sockets         = {}
         self._pending_sockets = []
+        #(port, address) bound with SO_REUSEPORT by each process in start.
+        self._pending_binds   = []
         self._backlog         = backlog
         self._start           = False
-
-    def bind(self, port, address=None):
+        self._edge_triggered  = edge_triggered
+        self._idle_timeout    = idle_timeout
+        self.ssl_options      = ssl_options
+        if ssl_options is not None:
+            self._ssl_context = ssl_options_to_context(ssl_options)
+        else:
+            self._ssl_context = None
+
+    def bind(self, port, address=None, reuse_port=False):
+        """
+        Bind the port, the sockets listen once `start` is called.
+
+        If ``reuse_port`` is True, the binding is delayed to `start`, every
+        forked process binds a SO_REUSEPORT socket of its own, see
+        `nida.util.netutil.bind_listen`. Port 0 is refused then, every
+        process would get a different port.
+        """
+        if reuse_port and not self._start:
+            if not hasattr(socket, "SO_REUSEPORT"):
+                raise ValueError("SO_REUSEPORT is not supported on this "
+                                 "platform")
+            if port == 0:
+                raise ValueError("reuse_port needs a fixed port, 0 would "
+                                 "bind a different port in every process")
+            self._pending_binds.append((port, address))
+            return
         sockets = bind_listen(port, address=address, family=socket.AF_INET,
                               socktype=socket.SOCK_STREAM,
-                              backlog=self._backlog)
+                              backlog=self._backlog, reuse_port=reuse_port)
         if self._start:
             self.add_sockets(sockets)
         else:
-            self._pending_sockets.append(sockets)
+            self._pending_sockets.extend(sockets)
 
-    def listen(self, port, address=""):
+    def listen(self, port, address="", reuse_port=False):
         socks = bind_listen(port, address=address, family=socket.AF_INET,
-                    sock_type=socket.SOCK_STREAM, backlog=self._backlog)
+                    socktype=socket.SOCK_STREAM, backlog=self._backlog,
+                    reuse_port=reuse_port)
         self.add_sockets(socks)
 
 
@@ -53,7 +114,15 @@ class TCPServer(object):
 
     def _handle_conn(self, conn, addr):
         try:
-            stream = IOStream(conn)
+            if self._ssl_context is not None:
+                conn = ssl_wrap_socket(conn, self._ssl_context,
+                                       server_side=True,
+                                       do_handshake_on_connect=False)
+                stream = SSLIOStream(conn, edge_triggered=self._edge_triggered,
+                                     idle_timeout=self._idle_timeout)
+            else:
+                stream = IOStream(conn, edge_triggered=self._edge_triggered,
+                                  idle_timeout=self._idle_timeout)
             self.handle_stream(stream, addr)
         except:
             app_log.error("error in handle connection", exc_info = True)
@@ -80,7 +149,33 @@ class TCPServer(object):
         self._start = True
         if process_num != 1:
             process.fork(process_num)
+            #the poller of the parent's IOLoop is shared by all the children,
+            #close our copies of its fds and run a loop of our own.
+            inherited = set([self.ioloop, IOLoop.current(instance=False)])
+            IOLoop.clear_instance()
+            for ioloop in inherited:
+                if ioloop is not None:
+                    ioloop.close_forked()
+            self.ioloop = IOLoop.current()
         self.add_sockets(self._pending_sockets)
+        for port, address in self._pending_binds:
+            self.add_sockets(bind_listen(port, address=address,
+                                         family=socket.AF_INET,
+                                         socktype=socket.SOCK_STREAM,
+                                         backlog=self._backlog,
+                                         reuse_port=True))
+        self._pending_binds = []
+
+    def ssl_session_stats(self):
+        """
+        Return the session counters of the SSL context, ``hits`` counts the
+        handshakes resumed by a session ticket. None if not serving SSL or the
+        ssl module has no session_stats.
+        """
+        if self._ssl_context is None or not hasattr(self._ssl_context,
+                                                    "session_stats"):
+            return None
+        return self._ssl_context.session_stats()
 
     def stop(self):
         for fd, sock in self._sockets.items():
@@ -0,0 +1,94 @@
+"""
+A process-wide pool of bytearray buffers for stream I/O.
+"""
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import threading
+
+class BufferPool(object):
+    """
+    Buffers are handed out in power of two size classes from ``min_size`` to
+    ``max_size``, a released buffer goes to the free list of its class while
+    the free buffers take at most ``max_free`` bytes. Larger buffers are not
+    pooled.
+
+    A released buffer keeps its old content, borrowers must only use the
+    bytes they have written.
+    """
+    _thread_lock = threading.Lock()
+
+    def __init__(self, min_size=4096, max_size=1024 * 1024,
+                 max_free=16 * 1024 * 1024):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_free = max_free
+        self._free = {}
+        size = min_size
+        while size <= max_size:
+            self._free[size] = []
+            size <<= 1
+        self._free_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def instance():
+        if not hasattr(BufferPool, "_instance"):
+            with BufferPool._thread_lock:
+                if not hasattr(BufferPool, "_instance"):
+                    BufferPool._instance = BufferPool()
+        return BufferPool._instance
+
+    def size_class(self, size):
+        """
+        Return the size of buffer acquire(size) gives.
+        """
+        if size > self.max_size:
+            return size
+        cls = self.min_size
+        while cls < size:
+            cls <<= 1
+        return cls
+
+    def acquire(self, size):
+        """
+        Return a bytearray of at least size bytes.
+        """
+        cls = self.size_class(size)
+        free = self._free.get(cls)
+        if free:
+            with self._lock:
+                if free:
+                    self._free_bytes -= cls
+                    self.hits += 1
+                    return free.pop()
+        self.misses += 1
+        return bytearray(cls)
+
+    def release(self, buf):
+        """
+        Give back a buffer from acquire, it must not be used any more.
+        """
+        size = len(buf)
+        free = self._free.get(size)
+        if free is None:
+            return
+        with self._lock:
+            if self._free_bytes + size <= self.max_free:
+                free.append(buf)
+                self._free_bytes += size
+
+    def clear(self):
+        with self._lock:
+            for free in self._free.values():
+                del free[:]
+            self._free_bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "free_bytes": self._free_bytes,
+        }
@@ -6,18 +6,19 @@ Static Factory to generate submodule.
 """
 
 class Factory(object):
+    """
+    Instantiating the base class creates its config_sub() class, or the class
+    given to configure().
+    """
     def __new__(cls, *args, **kwargs):
         base = cls.config_base()
         if base is cls:
-            impl = cls.config_sub()
+            impl = cls.configured_sub()
         else:
             impl = cls
 
-        instance = super(Factory, cls).__new__(impl)
-
-        instance.__init__(*args, **kwargs)
-
-        return instance
+        #__init__ is called by type() since impl is a subclass of cls.
+        return super(Factory, cls).__new__(impl)
 
     def config_base():
         raise NotImplementedError()
@@ -25,3 +26,20 @@ class Factory(object):
     def config_sub():
         raise NotImplementedError()
 
+    @classmethod
+    def configure(cls, impl):
+        """
+        Make the base create impl instead of config_sub(), None to restore.
+        """
+        base = cls.config_base()
+        if impl is not None and not issubclass(impl, base):
+            raise ValueError("Invalid subclass %r of %r" % (impl, base))
+        base._factory_impl = impl
+
+    @classmethod
+    def configured_sub(cls):
+        base = cls.config_base()
+        impl = base.__dict__.get("_factory_impl")
+        if impl is None:
+            impl = base.config_sub()
+        return impl
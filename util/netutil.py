@@ -0,0 +1,140 @@
+"""
+Network utilities: listening sockets, IP checks and SSL contexts.
+"""
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import errno
+import os
+import socket
+import ssl
+
+from nida.platform.posix import set_close_exec
+
+_DEFAULT_BACKLOG = 128
+
+#keys of the ssl options dict, see ssl_options_to_context.
+_SSL_PARAMS = frozenset(["ssl_version", "certfile", "keyfile", "cert_reqs",
+                         "ca_certs", "ciphers", "session_tickets"])
+
+#ssl.OP_NO_TICKET is exported since python 3.6, the value is OpenSSL's.
+_OP_NO_TICKET = getattr(ssl, "OP_NO_TICKET", 0x00004000)
+
+
+def bind_listen(port, address=None, family=socket.AF_UNSPEC,
+                socktype=socket.SOCK_STREAM, backlog=_DEFAULT_BACKLOG,
+                flags=None, reuse_port=False):
+    """
+    Return a list of non-blocking sockets listening on port of all the
+    addresses address resolves to, all interfaces if address is None or "".
+
+    If ``reuse_port`` is True, the sockets are set SO_REUSEPORT, so sockets
+    of other processes can listen on the same port and the kernel spreads
+    the connections among them.
+    """
+    if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        raise ValueError("SO_REUSEPORT is not supported on this platform")
+    sockets = []
+    if address == "":
+        address = None
+    if flags is None:
+        flags = socket.AI_PASSIVE
+    bound_port = None
+    for res in set(socket.getaddrinfo(address, port, family, socktype,
+                                      0, flags)):
+        af, socktype, proto, canonname, sockaddr = res
+        try:
+            sock = socket.socket(af, socktype, proto)
+        except socket.error as e:
+            if e.args[0] == errno.EAFNOSUPPORT:
+                continue
+            raise
+        set_close_exec(sock.fileno())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, "IPPROTO_IPV6"):
+            #the AF_INET socket of the same port takes the ipv4 addresses.
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        #port 0 binds all the addresses to the port the first one gets.
+        if port == 0 and bound_port is not None:
+            sockaddr = tuple([sockaddr[0], bound_port] + list(sockaddr[2:]))
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        bound_port = sock.getsockname()[1]
+        sock.listen(backlog)
+        sockets.append(sock)
+    return sockets
+
+
+def is_valid_ip(ip):
+    """
+    Return True if ip is an ipv4 or ipv6 address.
+    """
+    if not ip or '\x00' in ip:
+        return False
+    try:
+        res = socket.getaddrinfo(ip, 0, socket.AF_UNSPEC, socket.SOCK_STREAM,
+                                 0, socket.AI_NUMERICHOST)
+        return bool(res)
+    except socket.gaierror as e:
+        if e.args[0] == socket.EAI_NONAME:
+            return False
+        raise
+
+
+def ssl_options_to_context(ssl_options):
+    """
+    Return an ssl.SSLContext from a dict of ssl options, an SSLContext is
+    returned as it is.
+
+    The dict takes the arguments of ssl.wrap_socket: ``ssl_version``,
+    ``certfile``, ``keyfile``, ``cert_reqs``, ``ca_certs`` and ``ciphers``.
+    ``session_tickets`` (True by default) turns TLS session tickets on or
+    off.
+
+    A server should build its context once and wrap every connection with
+    it: the ticket keys live in the context, so a returning client resumes
+    its session and skips the full handshake. Tickets are the only
+    resumption this context offers, the ssl module of python 2.7 sets no
+    session id context, so no session is cached by id (``number`` of
+    ``SSLContext.session_stats()`` stays 0) and a client without tickets
+    always does a full handshake. Resumed handshakes are counted in
+    ``hits``.
+    """
+    if isinstance(ssl_options, ssl.SSLContext):
+        return ssl_options
+    assert isinstance(ssl_options, dict), ssl_options
+    unknown = set(ssl_options) - _SSL_PARAMS
+    if unknown:
+        raise ValueError("Unknown ssl options: %s" % ", ".join(sorted(unknown)))
+    context = ssl.SSLContext(ssl_options.get("ssl_version",
+                                             ssl.PROTOCOL_SSLv23))
+    if "certfile" in ssl_options:
+        if not os.path.exists(ssl_options["certfile"]):
+            raise ValueError("certfile %r does not exist" %
+                             ssl_options["certfile"])
+        context.load_cert_chain(ssl_options["certfile"],
+                                ssl_options.get("keyfile"))
+    if "cert_reqs" in ssl_options:
+        context.verify_mode = ssl_options["cert_reqs"]
+    if "ca_certs" in ssl_options:
+        context.load_verify_locations(ssl_options["ca_certs"])
+    if "ciphers" in ssl_options:
+        context.set_ciphers(ssl_options["ciphers"])
+    if hasattr(ssl, "OP_NO_COMPRESSION"):
+        context.options |= ssl.OP_NO_COMPRESSION
+    if not ssl_options.get("session_tickets", True):
+        context.options |= _OP_NO_TICKET
+    return context
+
+
+def ssl_wrap_socket(sock, ssl_options, server_hostname=None, **kwargs):
+    """
+    Wrap sock with an SSLContext or a dict of ssl options, see
+    `ssl_options_to_context`. Other arguments go to SSLContext.wrap_socket.
+    """
+    context = ssl_options_to_context(ssl_options)
+    if server_hostname is not None and ssl.HAS_SNI:
+        kwargs["server_hostname"] = server_hostname
+    return context.wrap_socket(sock, **kwargs)
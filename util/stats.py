@@ -0,0 +1,51 @@
+"""
+Cheap counters and histograms for runtime statistics.
+"""
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division
+
+import bisect
+
+#bucket upper bounds for durations in seconds, from 100us to 10s.
+TIME_BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+#bucket upper bounds for small counts.
+COUNT_BOUNDS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class Histogram(object):
+    """
+    A fixed-bucket histogram. Values greater than the last bound fall into an
+    overflow bucket.
+    """
+    __slots__ = ['bounds', 'buckets', 'count', 'total', 'max']
+
+    def __init__(self, bounds=TIME_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def to_dict(self):
+        """
+        Return a dict with count, sum, max and buckets as a list of
+        (upper bound, count) pairs, the overflow bucket's bound is None.
+        """
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "buckets": list(zip(self.bounds + (None,), self.buckets)),
+        }